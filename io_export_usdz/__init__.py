@@ -9,55 +9,22 @@ bl_info = {
     "category":    "Import-Export"
     }
 
-import bpy
-from bpy.props import (
-        BoolProperty,
-        FloatProperty,
-        IntProperty,
-        StringProperty,
-        EnumProperty,
-        )
-from bpy_extras.io_utils import (
-        ImportHelper,
-        ExportHelper,
-        orientation_helper_factory,
-        path_reference_mode,
-        axis_conversion,
-        )
+try:
+    import bpy
+except ImportError:
+    # Spawned export workers import print_usda outside of Blender
+    bpy = None
 
-from bpy_extras.io_utils import ExportHelper
-
-class ExportUSDZ(bpy.types.Operator, ExportHelper):
-    bl_idname       = "export.usdz"
-    bl_label        = "Export USDZ File"
-    bl_options      = {'PRESET'}
-
-    filename_ext    = ".usdz"
-
-    exportMaterials = BoolProperty(name="Export Materials", description="Export Materials from Objects", default=True)
-    keepUSDA = BoolProperty(name="Keep USDA", description="Keep generated USDA and image files", default=False)
-    animated = BoolProperty(name="Export Animations", description="Export Ridgid Body Animations", default=False)
-    bakeAO = BoolProperty(name="Bake AO", description="Bake Ambiant Occlusion Texture", default=False)
-    samples = IntProperty(name="Samples", description="Number of Samples for Ambiant Occlusion", min=1, max=1000, default= 8)
-    scale = FloatProperty(name="Scale", min=0.01, max=1000.0, default=1.0)
-
-    def execute(self, context):
-        from . import export_usdz
-        keywords = self.as_keywords(ignore=("global_scale",
-                                            "check_existing",
-                                            "filter_glob",
-                                            ))
-        return export_usdz.export_usdz(context, **keywords)
-
-
-def menu_func_usdz_export(self, context):
-    self.layout.operator(ExportUSDZ.bl_idname, text="USDZ (.usdz)");
+if bpy != None:
+    from .operators import ExportUSDZ, StopUSDZWatch, menu_func_usdz_export
 
 def register():
     bpy.utils.register_module(__name__);
     bpy.types.INFO_MT_file_export.append(menu_func_usdz_export);
 
 def unregister():
+    from . import export_usdz
+    export_usdz.unwatch_usdz()
     bpy.utils.unregister_module(__name__);
     bpy.types.INFO_MT_file_export.remove(menu_func_usdz_export);
 
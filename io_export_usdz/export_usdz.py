@@ -4,82 +4,110 @@ import mathutils
 import subprocess
 import tempfile
 import shutil
+import threading
+import multiprocessing
+import collections
+import hashlib
+import json
+import time
+import concurrent.futures
+import queue
+import numpy
+from .print_usda import *
 
 
 # Defines
-tab = '    '
 pi = 3.1415926
-epslon = 0.000001
 defaultMaterialName = 'DefaultMaterial'
+materialImageFiles = collections.OrderedDict([('colorMap', '_color'), ('normalMap', '_normal'), ('emissiveMap', '_emissive'), ('metallicMap', '_metallic'), ('roughnessMap', '_roughness')])
+passthroughFormats = {'PNG': '.png', 'JPEG': '.jpg'}
 
+# Modifiers changing over time on their own, or following other objects
+timeModifiers = set(['BUILD', 'CLOTH', 'DYNAMIC_PAINT', 'EXPLODE', 'FLUID_SIMULATION', 'MESH_CACHE', 'MESH_SEQUENCE_CACHE', 'OCEAN', 'PARTICLE_INSTANCE', 'PARTICLE_SYSTEM', 'SMOKE', 'SOFT_BODY', 'WAVE'])
+modifierObjectAttributes = ['object', 'offset_object', 'mirror_object', 'texture_coords_object', 'origin', 'target', 'auxiliary_target', 'object_from', 'object_to', 'curve']
 
+exportPhases = ['Sampling Animation', 'Exporting Objects', 'Exporting Materials', 'Writing USDA', 'Writing USDZ']
 
-################################################################################
-##                             Helper Methods                                 ##
-################################################################################
+# Keywords of export_usdz_targets applying to the single shared extraction
+extractKeywords = ['maxChunkVertices', 'stageVertices', 'pipelined', 'vertexQuantization', 'animationWorkers', 'samples', 'dryRun', 'enforceBudget']
 
-# Returns Tuple as comma seprated string
-def printTuple(t):
-    return ', '.join('%.6g' % round(f, 6) for f in t)
+# AR Quick Look budgets and output size estimates
+arBudgets = collections.OrderedDict([('vertices', 100000), ('faceVaryingElements', 300000), ('joints', 256), ('timeSamples', 500000), ('texturePixels', 8*2048*2048), ('bytes', 25*1024*1024)])
+bytesPerScalar = 4
+bytesPerPixel = 2
 
-def printIndices(indices):
-    return ', '.join(format(i, 'd') for i in indices)
+# Per export caches, cleared when an export or estimate begins and ends
+shaderNodes = {}
 
-def printVectors(vectors):
-    return ', '.join('(' + printTuple(v) + ')' for v in vectors)
+# Caches kept between exports
+generatedUVs = {}
+activeWatcher = None
 
 
 
 ################################################################################
-##                          Object Helper Methods                             ##
+##                          Progress Helper Methods                           ##
 ################################################################################
 
-def organizeObjects(active, objs):
-    objs.remove(active)
-    return [active] + objs
+def reportProgress(options, phase, progress):
+    checkCancelled(options)
+    callback = options.get('progressCallback')
+    if callback != None:
+        callback(phase, progress)
 
 
-def copyObject(obj):
-    selectObject(obj)
-    bpy.ops.object.duplicate()
-    return bpy.context.active_object
+def pollProcesses(processes, options):
+    try:
+        checkCancelled(options)
+    except ExportCancelled:
+        for process in processes:
+            if process.poll() == None:
+                process.kill()
+                process.wait()
+        raise
+    return all(process.poll() != None for process in processes)
 
 
-def copyObjects(objs):
-    return [copyObject(obj) for obj in objs]
+def waitProcesses(processes, options):
+    while not pollProcesses(processes, options):
+        time.sleep(0.1)
 
 
-def selectObject(obj):
-    bpy.ops.object.select_all(action='DESELECT')
-    obj.select = True
-    bpy.context.scene.objects.active = obj
+def runProcess(args, options):
+    waitProcesses([subprocess.Popen(args)], options)
 
 
-def selectObjects(objs):
-    bpy.ops.object.select_all(action='DESELECT')
-    for obj in objs:
-        obj.select = True
-    bpy.context.scene.objects.active = objs[0]
+def replaceFile(src, dst):
+    # Stage next to the target so the final rename is atomic
+    staged = dst + '.tmp'
+    shutil.copyfile(src, staged)
+    os.replace(staged, dst)
 
 
-def deleteObject(obj):
-    selectObject(obj)
-    bpy.ops.object.delete()
 
+################################################################################
+##                          Object Helper Methods                             ##
+################################################################################
 
-def deleteObjects(objs):
-    for obj in objs:
-        deleteObject(obj)
+def organizeObjects(active, objs):
+    objs.remove(active)
+    return [active] + objs
 
 
-def getObjectMaterial(obj):
-    if obj.type == 'MESH' and len(obj.data.materials) > 0:
-        return obj.data.materials[0]
+def selectObject(obj):
+    bpy.ops.object.select_all(action='DESELECT')
+    obj.select = True
+    bpy.context.scene.objects.active = obj
+
+
+def getObjectMaterial(obj, index = 0):
+    if obj.type == 'MESH' and len(obj.data.materials) > index:
+        return obj.data.materials[index]
     return None
 
 
-def getObjectMaterialName(obj):
-    mat = getObjectMaterial(obj)
+def getObjectMaterialName(obj, index = 0):
+    mat = getObjectMaterial(obj, index)
     if mat != None:
         return mat.name.replace('.', '_')
     return defaultMaterialName
@@ -115,17 +143,147 @@ def createImage(name, width, height, file):
     image.file_format = 'PNG'
     return image
 
+################################################################################
+##                        Geometry Staging Methods                            ##
+################################################################################
+
+def getStagingPath(options):
+    path = options['tempPath'] + 'staging/'
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def createStagedArray(directory, dtype, shape):
+    handle, path = tempfile.mkstemp(suffix='.bin', dir=directory)
+    os.close(handle)
+    staged = StagedArray(path, dtype, shape)
+    return (staged, numpy.memmap(path, dtype=dtype, mode='w+', shape=staged.shape))
+
+def stageArray(values, directory):
+    # Written with plain file writes, flushing a mapping syncs it to disk
+    handle, path = tempfile.mkstemp(suffix='.bin', dir=directory)
+    f = os.fdopen(handle, 'wb')
+    numpy.ascontiguousarray(values).tofile(f)
+    f.close()
+    return StagedArray(path, values.dtype.str, values.shape)
+
+def stageCollection(collection, attr, dtype, width, directory):
+    # Fill a staged array straight from a bpy collection
+    shape = (len(collection), width) if width > 1 else (len(collection),)
+    staged, array = createStagedArray(directory, dtype, shape)
+    collection.foreach_get(attr, array.reshape(-1))
+    array.flush()
+    return staged
+
+def removeStagedArrays(mesh):
+    for value in mesh.values():
+        if isinstance(value, StagedArray) and os.path.exists(value.path):
+            os.remove(value.path)
+
+def useStaging(obj, data, options):
+    # Skinned and vertex animated meshes keep their per vertex data in lists
+    if options['stageVertices'] <= 0 or len(data.vertices) <= options['stageVertices']:
+        return False
+    return len(obj.vertex_groups) == 0 and not hasVertexAnimation(obj, options)
+
+def exportStagedMesh(obj, data, options):
+    directory = getStagingPath(options)
+    data.calc_normals_split()
+    loops = len(data.loops)
+    
+    mesh = {}
+    mesh['name'] = obj.data.name.replace('.', '_')
+    mesh['material'] = getObjectMaterialName(obj)
+    mesh['staged'] = True
+    mesh['faceVertexCounts'] = stageCollection(data.polygons, 'loop_total', 'i4', 1, directory)
+    mesh['faceVertexIndices'] = stageCollection(data.loops, 'vertex_index', 'i4', 1, directory)
+    mesh['points'] = stageCollection(data.vertices, 'co', 'f4', 3, directory)
+    mesh['normalIndices'] = stageArray(numpy.arange(loops, dtype='i4'), directory)
+    mesh['normals'] = stageCollection(data.loops, 'normal', 'f4', 3, directory)
+    mesh['uvIndices'] = []
+    mesh['uvs'] = None
+    if len(data.uv_layers) > 0:
+        mesh['uvIndices'] = stageArray(numpy.arange(loops, dtype='i4'), directory)
+        mesh['uvs'] = stageCollection(data.uv_layers.active.data, 'uv', 'f4', 2, directory)
+    mesh['weights'] = None
+    mesh['skeleton'] = getSkeletonPath(obj)
+    mesh['animationSource'] = getAnimationPath(obj)
+    mesh['pointSamples'] = None
+    return mesh
+
+def getStagedMaterialIndices(data):
+    materialIndices = numpy.empty(len(data.polygons), dtype='i4')
+    data.polygons.foreach_get('material_index', materialIndices)
+    return materialIndices
+
+def getStagedLoopStarts(mesh):
+    counts = mesh['faceVertexCounts'].load()
+    return numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+
+def getStagedLoops(mesh, polygons, loopStarts):
+    # Loops of the given polygons, without a pass over the rest of the mesh
+    sizes = mesh['faceVertexCounts'].load()[polygons]
+    ends = numpy.cumsum(sizes)
+    total = ends[-1] if len(ends) > 0 else 0
+    return numpy.arange(total) + numpy.repeat(loopStarts[polygons] - (ends - sizes), sizes)
+
+def subsetStagedMesh(mesh, polygons, loopStarts):
+    directory = os.path.dirname(mesh['points'].path)
+    polygons = numpy.asarray(polygons, dtype='i8')
+    loops = getStagedLoops(mesh, polygons, loopStarts)
+    vertices, faceVertexIndices = numpy.unique(mesh['faceVertexIndices'].load()[loops], return_inverse=True)
+    
+    subset = dict(mesh)
+    subset['faceVertexCounts'] = stageArray(mesh['faceVertexCounts'].load()[polygons], directory)
+    subset['faceVertexIndices'] = stageArray(faceVertexIndices.astype('i4'), directory)
+    subset['points'] = stageArray(mesh['points'].load()[vertices], directory)
+    subset['normalIndices'] = stageArray(numpy.arange(len(loops), dtype='i4'), directory)
+    subset['normals'] = stageArray(mesh['normals'].load()[mesh['normalIndices'].load()[loops]], directory)
+    if mesh['uvs'] != None:
+        subset['uvIndices'] = stageArray(numpy.arange(len(loops), dtype='i4'), directory)
+        subset['uvs'] = stageArray(mesh['uvs'].load()[mesh['uvIndices'].load()[loops]], directory)
+    return subset
+
+def getStagedPolygonCenters(mesh, loopStarts):
+    counts = mesh['faceVertexCounts'].load()
+    points = mesh['points'].load()[mesh['faceVertexIndices'].load()]
+    return numpy.add.reduceat(points, loopStarts, axis=0) / counts[:, None]
+
+def countStagedVertices(indices, owners):
+    # Every distinct vertex keeps exactly one of the positions written to it,
+    # which counts them in linear time with a scratch array the mesh's size
+    positions = numpy.arange(len(indices))
+    owners[indices] = positions
+    return numpy.count_nonzero(owners[indices] == positions)
+
+def partitionStagedPolygons(mesh, polygons, centers, loopStarts, owners, maxVertices, parts):
+    # Same halving as partitionPolygons, on index arrays. Each level only
+    # reads the loops of its own polygons.
+    loops = getStagedLoops(mesh, polygons, loopStarts)
+    vertices = countStagedVertices(mesh['faceVertexIndices'].load()[loops], owners)
+    if vertices <= maxVertices or len(polygons) < 2:
+        parts.append(polygons)
+    else:
+        selected = centers[polygons]
+        axis = numpy.argmax(selected.max(axis=0) - selected.min(axis=0))
+        polygons = polygons[numpy.argsort(selected[:, axis], kind='mergesort')]
+        half = len(polygons)//2
+        partitionStagedPolygons(mesh, polygons[:half], centers, loopStarts, owners, maxVertices, parts)
+        partitionStagedPolygons(mesh, polygons[half:], centers, loopStarts, owners, maxVertices, parts)
+
+def getStagedExtents(mesh):
+    points = mesh['points'].load()
+    return [tuple(float(f) for f in points.min(axis=0)), tuple(float(f) for f in points.max(axis=0))]
+
 ################################################################################
 ##                           Export Mesh Methods                              ##
 ################################################################################
 
 
-def getObjectExtents(obj):
-    low = obj.bound_box[0][:]
-    high = obj.bound_box[0][:]
-    for v in obj.bound_box:
-        low = min(low, v[:])
-        high = max(high, v[:])
+def getPointsExtents(points):
+    if len(points) == 0:
+        return [(0.0, 0.0, 0.0), (0.0, 0.0, 0.0)]
+    low = tuple(min(p[i] for p in points) for i in range(3))
+    high = tuple(max(p[i] for p in points) for i in range(3))
     return [low, high]
 
 
@@ -143,19 +301,11 @@ def getFaceVertexIndices(mesh):
 def getVertexPoints(mesh):
     return [v.co[:] for v in mesh.vertices]
 
-def getVertexWeights(obj):
+def getVertexWeights(obj, mesh):
     if len(obj.vertex_groups) > 0:
         vertexWeights = []
-        for i in range(0, len(obj.data.vertices)):
-            weights = []
-            for group in obj.vertex_groups:
-                try:
-                    weight = group.weight(i)
-                    if weight > epslon:
-                        weights.append((group.index, weight))
-                except RuntimeError:
-                    pass
-            vertexWeights.append(weights)
+        for v in mesh.vertices:
+            vertexWeights.append([(g.group, g.weight) for g in v.groups if g.weight > epslon])
         return vertexWeights
     return None
 
@@ -185,6 +335,8 @@ def getIndexedUVs(mesh):
     indices = []
     uvs = []
     map = mesh.uv_layers.active
+    if map == None:
+        return (indices, None)
     for point in map.data:
         uv = point.uv[:]
         if uv in uvs:
@@ -206,56 +358,262 @@ def getAnimationPath(obj):
         return '/' + obj.name.replace('.', '_') + '/' + arm.animation_data.action.name.replace('.', '_')
     return None
 
-def exportMeshes(obj, options):
-    objCopy = copyObject(obj)
+def getMeshFingerprint(mesh):
+    fingerprint = hashlib.sha1()
+    for key in ['points', 'faceVertexCounts', 'faceVertexIndices', 'normals', 'normalIndices', 'uvs', 'uvIndices', 'weights']:
+        if isinstance(mesh[key], StagedArray):
+            mesh[key].updateHash(fingerprint)
+        else:
+            fingerprint.update(repr(mesh[key]).encode())
+    return fingerprint.hexdigest()
+
+def isInstanceable(mesh):
+    return mesh['skeleton'] == None and mesh['pointSamples'] == None
+
+def instanceMeshes(objs, path, prototypes):
+    # The first mesh with a given geometry becomes the prototype of the others
+    for obj in objs:
+        objPath = path + '/' + obj['name']
+        if obj['skeleton'] == None:
+            instanceMeshes(obj['children'], objPath, prototypes)
+        for mesh in obj['meshes']:
+            mesh['prototype'] = None
+            if isInstanceable(mesh):
+                if mesh['fingerprint'] in prototypes:
+                    mesh['prototype'] = prototypes[mesh['fingerprint']]
+                else:
+                    prototypes[mesh['fingerprint']] = objPath + '/' + mesh['name']
+
+def materialHasTextures(mat):
+    if mat != None:
+        material = exportMaterial(mat)
+        return any(material[key] != None for key in materialImageFiles)
+    return False
+
+def objectNeedsUVs(obj, options):
+    if options['exportMaterials']:
+        return any(materialHasTextures(mat) for mat in obj.data.materials)
+    return False
+
+def getMeshSignature(mesh):
+    # The unwrap depends on the shape as well as the topology
+    signature = hashlib.sha1()
+    signature.update(repr(getFaceVertexIndices(mesh)).encode())
+    signature.update(repr([v.co[:] for v in mesh.vertices]).encode())
+    return signature.hexdigest()
+
+def unwrapMesh(mesh):
+    # The unwrap operator needs an object, so a temporary one is linked to the scene
+    scene = bpy.context.scene
+    selected = list(bpy.context.selected_objects)
+    active = scene.objects.active
     
-    # Create UV Map if not avalible
-    if len(objCopy.data.uv_layers) == 0:
-        bpy.ops.uv.smart_project()
+    obj = bpy.data.objects.new('USDZ_Unwrap', mesh.copy())
+    scene.objects.link(obj)
+    selectObject(obj)
+    bpy.ops.uv.smart_project()
+    uvs = []
+    for point in obj.data.uv_layers.active.data:
+        uvs += point.uv[:]
     
-    # Rotate to USD Coorinate Space
-    #objCopy.rotation_mode = 'XYZ'
-    #objCopy.rotation_euler = (-pi/2.0, 0.0, 0.0)
-    #bpy.ops.object.transform_apply(location = True, scale = True, rotation = True)
+    # Remove the temporary object and restore the selection
+    data = obj.data
+    scene.objects.unlink(obj)
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(data)
+    bpy.ops.object.select_all(action='DESELECT')
+    for selectedObj in selected:
+        selectedObj.select = True
+    scene.objects.active = active
+    return uvs
+
+def generateUVs(obj, mesh):
+    # Reuse the previous unwrap of this mesh datablock if its shape is unchanged
+    signature = getMeshSignature(mesh)
+    cached = generatedUVs.get(obj.data.name)
+    if cached == None or cached['signature'] != signature:
+        cached = {'signature': signature, 'uvs': unwrapMesh(mesh)}
+        generatedUVs[obj.data.name] = cached
+    mesh.uv_textures.new()
+    mesh.uv_layers.active.data.foreach_set('uv', cached['uvs'])
+
+def getEvaluatedMesh(obj):
+    # Skinned meshes are exported in their rest shape
+    skinned = obj.parent != None and obj.parent.type == 'ARMATURE'
+    return obj.to_mesh(bpy.context.scene, not skinned, 'PREVIEW')
+
+def compactIndexed(indices, values):
+    remap = {}
+    compacted = []
+    newIndices = []
+    for i in indices:
+        if not i in remap:
+            remap[i] = len(compacted)
+            compacted.append(values[i])
+        newIndices.append(remap[i])
+    return (newIndices, compacted)
+
+def getLoopStarts(mesh):
+    loopStarts = [0]
+    for count in mesh['faceVertexCounts']:
+        loopStarts.append(loopStarts[-1] + count)
+    return loopStarts
+
+def subsetMesh(mesh, polygons, loopStarts=None):
+    # Copy of the mesh with only the given polygons and the data they use
+    if mesh['staged']:
+        if loopStarts is None:
+            loopStarts = getStagedLoopStarts(mesh)
+        return subsetStagedMesh(mesh, polygons, loopStarts)
+    if loopStarts == None:
+        loopStarts = getLoopStarts(mesh)
+    loops = []
+    for p in polygons:
+        loops += range(loopStarts[p], loopStarts[p+1])
     
-    name = obj.data.name.replace('.', '_')
-    multiMat = len(obj.material_slots) > 1
+    vertices = []
+    vertexMap = {}
+    faceVertexIndices = []
+    for l in loops:
+        v = mesh['faceVertexIndices'][l]
+        if not v in vertexMap:
+            vertexMap[v] = len(vertices)
+            vertices.append(v)
+        faceVertexIndices.append(vertexMap[v])
     
-    skeleton = getSkeletonPath(obj)
-    animationSource = getAnimationPath(obj)
+    subset = dict(mesh)
+    subset['faceVertexCounts'] = [mesh['faceVertexCounts'][p] for p in polygons]
+    subset['faceVertexIndices'] = faceVertexIndices
+    subset['points'] = [mesh['points'][v] for v in vertices]
+    subset['normalIndices'], subset['normals'] = compactIndexed([mesh['normalIndices'][l] for l in loops], mesh['normals'])
+    if mesh['uvs'] != None:
+        subset['uvIndices'], subset['uvs'] = compactIndexed([mesh['uvIndices'][l] for l in loops], mesh['uvs'])
+    if mesh['weights'] != None:
+        subset['weights'] = [mesh['weights'][v] for v in vertices]
+    if mesh['pointSamples'] != None:
+        subset['pointSamples'] = [(frame, [points[v] for v in vertices]) for frame, points in mesh['pointSamples']]
+    return subset
+
+def getMeshExtents(mesh):
+    if mesh['staged']:
+        return getStagedExtents(mesh)
+    points = mesh['points']
+    if mesh['pointSamples'] != None:
+        points = points + [p for frame, samplePoints in mesh['pointSamples'] for p in samplePoints]
+    return getPointsExtents(points)
+
+def getPolygonCenters(mesh, loopStarts):
+    centers = []
+    for p, count in enumerate(mesh['faceVertexCounts']):
+        points = [mesh['points'][v] for v in mesh['faceVertexIndices'][loopStarts[p]:loopStarts[p+1]]]
+        centers.append(tuple(sum(point[i] for point in points)/count for i in range(3)))
+    return centers
+
+def partitionPolygons(mesh, polygons, centers, loopStarts, maxVertices, parts):
+    # Halve the polygons along the longest axis until each part fits the budget
+    vertices = set()
+    for p in polygons:
+        vertices.update(mesh['faceVertexIndices'][loopStarts[p]:loopStarts[p+1]])
+    if len(vertices) <= maxVertices or len(polygons) < 2:
+        parts.append(polygons)
+    else:
+        low, high = getPointsExtents([centers[p] for p in polygons])
+        axis = max(range(3), key=lambda i: high[i] - low[i])
+        polygons = sorted(polygons, key=lambda p: centers[p][axis])
+        half = len(polygons)//2
+        partitionPolygons(mesh, polygons[:half], centers, loopStarts, maxVertices, parts)
+        partitionPolygons(mesh, polygons[half:], centers, loopStarts, maxVertices, parts)
+
+def chunkMesh(mesh, maxVertices):
+    if maxVertices <= 0 or len(mesh['points']) <= maxVertices:
+        return [mesh]
+    parts = []
+    if mesh['staged']:
+        loopStarts = getStagedLoopStarts(mesh)
+        centers = getStagedPolygonCenters(mesh, loopStarts)
+        owners = numpy.empty(len(mesh['points']), dtype='i8')
+        partitionStagedPolygons(mesh, numpy.arange(len(centers)), centers, loopStarts, owners, maxVertices, parts)
+        parts = [numpy.sort(polygons) for polygons in parts]
+    else:
+        loopStarts = getLoopStarts(mesh)
+        centers = getPolygonCenters(mesh, loopStarts)
+        partitionPolygons(mesh, list(range(len(centers))), centers, loopStarts, maxVertices, parts)
+        parts = [sorted(polygons) for polygons in parts]
+    chunks = []
+    for i, polygons in enumerate(parts):
+        chunk = subsetMesh(mesh, polygons, loopStarts)
+        chunk['name'] += '_%d' % i
+        chunks.append(chunk)
+    
+    # Chunks are staged in their own files
+    if mesh['staged']:
+        removeStagedArrays(mesh)
+    return chunks
+
+def getMaterialPolygons(materialIndices):
+    if isinstance(materialIndices, numpy.ndarray):
+        return [(int(index), numpy.flatnonzero(materialIndices == index)) for index in numpy.unique(materialIndices)]
+    return [(index, [p for p, m in enumerate(materialIndices) if m == index]) for index in sorted(set(materialIndices))]
+
+def exportMeshes(obj, options):
+    # Read the evaluated mesh data without touching the scene or selection
+    data = getEvaluatedMesh(obj)
+    
+    # Create UV Map if not avalible and a texture needs one
+    if len(data.uv_layers) == 0 and objectNeedsUVs(obj, options):
+        generateUVs(obj, data)
+    
+    # Huge meshes are staged on disk instead of in lists
+    if useStaging(obj, data, options):
+        mesh = exportStagedMesh(obj, data, options)
+        materialIndices = getStagedMaterialIndices(data)
+    else:
+        mesh = exportMeshData(obj, data, options)
+        materialIndices = [poly.material_index for poly in data.polygons]
+    bpy.data.meshes.remove(data)
     
     # Seperate the Mesh by Material
-    objs = [objCopy]
-    if multiMat:
-        bpy.ops.mesh.separate(type='MATERIAL')
-        objs = bpy.context.selected_objects
+    meshes = [mesh]
+    if len(obj.material_slots) > 1:
+        meshes = []
+        for index, polygons in getMaterialPolygons(materialIndices):
+            subset = subsetMesh(mesh, polygons)
+            subset['material'] = getObjectMaterialName(obj, index)
+            subset['name'] += '_' + subset['material']
+            meshes.append(subset)
+        if mesh['staged']:
+            removeStagedArrays(mesh)
     
-    meshes = []
-    for obj in objs:
-        indexedNormals = getIndexedNormals(obj.data)
-        indexedUVs = getIndexedUVs(obj.data)
-    
-        mesh = {}
-        mesh['name'] = name
-        mesh['material'] = getObjectMaterialName(obj)
-        mesh['extent'] = getObjectExtents(obj)
-        mesh['faceVertexCounts'] = getFaceVertexCounts(obj.data)
-        mesh['faceVertexIndices'] = getFaceVertexIndices(obj.data)
-        mesh['points'] = getVertexPoints(obj.data)
-        mesh['normalIndices'] = indexedNormals[0]
-        mesh['normals'] = indexedNormals[1]
-        mesh['uvIndices'] = indexedUVs[0]
-        mesh['uvs'] = indexedUVs[1]
-        mesh['weights'] = getVertexWeights(obj)
-        mesh['skeleton'] = skeleton
-        mesh['animationSource'] = animationSource
-        
-        if multiMat:
-            mesh['name'] += '_' + mesh['material']
-        deleteObject(obj)
-        meshes.append(mesh)
+    # Split huge meshes into spatially coherent chunks under the vertex budget
+    meshes = [chunk for mesh in meshes for chunk in chunkMesh(mesh, options['maxChunkVertices'])]
+    
+    for mesh in meshes:
+        mesh['extent'] = getMeshExtents(mesh)
+        mesh['fingerprint'] = getMeshFingerprint(mesh)
+        mesh['prototype'] = None
     return meshes
 
+def exportMeshData(obj, data, options):
+    indexedNormals = getIndexedNormals(data)
+    indexedUVs = getIndexedUVs(data)
+    
+    mesh = {}
+    mesh['name'] = obj.data.name.replace('.', '_')
+    mesh['material'] = getObjectMaterialName(obj)
+    mesh['staged'] = False
+    mesh['faceVertexCounts'] = getFaceVertexCounts(data)
+    mesh['faceVertexIndices'] = getFaceVertexIndices(data)
+    mesh['points'] = getVertexPoints(data)
+    mesh['normalIndices'] = indexedNormals[0]
+    mesh['normals'] = indexedNormals[1]
+    mesh['uvIndices'] = indexedUVs[0]
+    mesh['uvs'] = indexedUVs[1]
+    mesh['weights'] = getVertexWeights(obj, data)
+    mesh['skeleton'] = getSkeletonPath(obj)
+    mesh['animationSource'] = getAnimationPath(obj)
+    mesh['pointSamples'] = exportPointSamples(obj, len(mesh['points']), options)
+    return mesh
+
 def exportMatrix(matrix):
     matrix = mathutils.Matrix.transposed(matrix)
     return [col[:] for col in matrix[:]]
@@ -321,7 +679,7 @@ def getArmatureScales(arm, scale):
 def getArmatureTranslations(arm, scale):
     translations = []
     for bone in arm.pose.bones:
-        location = bone.location
+        location = bone.location.copy()
         if bone.parent != None:
             location += mathutils.Vector((0, bone.parent.length, 0))
         else:
@@ -330,30 +688,13 @@ def getArmatureTranslations(arm, scale):
     return translations
 
 def exportSkelAnimation(arm, options):
-    scale = options['scale']
-    rotations = []
-    scales = []
-    translations = []
-    
-    options['animated'] = True
-    
-    originalFrame = bpy.context.scene.frame_current
-    action = arm.animation_data.action
-    frame_begin = options['startTimeCode']
-    frame_end = options['endTimeCode']
-    for frame in range(frame_begin, frame_end+1):
-        bpy.context.scene.frame_set(frame)
-        rotations.append((frame, [bone.rotation_quaternion[:] for bone in arm.pose.bones]))
-        scales.append((frame, getArmatureScales(arm, scale)))
-        translations.append((frame, getArmatureTranslations(arm, scale)))
-    bpy.context.scene.frame_set(originalFrame)
-    
+    samples = options['frameSamples'][arm.name]
     animation = {}
     animation['name'] = arm.animation_data.action.name.replace('.', '_')
     animation['jointTokens'] = exportJointTokens(arm)
-    animation['rotations'] = rotations
-    animation['scales'] = scales
-    animation['translations'] = translations
+    animation['rotations'] = samples['rotations']
+    animation['scales'] = samples['scales']
+    animation['translations'] = samples['translations']
     return animation
 
 def exportAnimation(obj, options):
@@ -362,35 +703,228 @@ def exportAnimation(obj, options):
         return exportSkelAnimation(arm, options)
     return None
 
-def exportRootTimeSamples(obj, options):
-    originalFrame = bpy.context.scene.frame_current
-    frame_begin = options['startTimeCode']
-    frame_end = options['endTimeCode']
-    samples = []
-    for frame in range(frame_begin, frame_end+1):
-        bpy.context.scene.frame_set(frame)
-        samples.append((frame, exportRootMatrix(obj.matrix_world, options)))
-    bpy.context.scene.frame_set(originalFrame)
+def exportTimeSamples(obj, options):
+    if obj.name in options['frameSamples']:
+        return options['frameSamples'][obj.name]['transforms']
+    return []
+
+def hasAnimatedPath(animationData, prefix):
+    if animationData == None:
+        return False
+    paths = [driver.data_path for driver in animationData.drivers]
+    if animationData.action != None:
+        paths += [curve.data_path for curve in animationData.action.fcurves]
+    return any(path.startswith(prefix) for path in paths)
+
+def isModifierAnimated(obj, modifier):
+    # Static modifiers like Subdivision or Bevel give the same result every frame
+    if modifier.type in timeModifiers:
+        return True
+    if any(getattr(modifier, attr, None) != None for attr in modifierObjectAttributes):
+        return True
+    return hasAnimatedPath(obj.animation_data, 'modifiers["%s"]' % modifier.name)
+
+def isDeforming(obj):
+    keys = obj.data.shape_keys
+    if keys != None and len(keys.key_blocks) > 1 and hasAnimatedPath(keys.animation_data, ''):
+        return True
+    return any(modifier.type != 'ARMATURE' and isModifierAnimated(obj, modifier) for modifier in obj.modifiers)
+
+def hasVertexAnimation(obj, options):
+    if options['animated'] and options['vertexAnimation']:
+        if obj.parent == None or obj.parent.type != 'ARMATURE':
+            return isDeforming(obj)
+    return False
+
+def getAnimationTargets(objs, options):
+    targets = collections.OrderedDict()
+    for obj in objs:
+        if obj.type == 'MESH' and obj.parent != None and obj.parent.type == 'ARMATURE':
+            targets[obj.parent.name] = ['skeleton']
+    
+    # Skinned meshes always export their animation
+    if len(targets) > 0:
+        options['animated'] = True
+    
+    if options['animated']:
+        for obj in objs:
+            if obj.type == 'MESH':
+                node = obj
+                while node != None and node.type != 'ARMATURE':
+                    # Keep any kind an earlier object already added for this node
+                    if node.parent == None:
+                        kind = 'root'
+                    elif node.parent.type != 'ARMATURE':
+                        kind = 'local'
+                    else:
+                        kind = None
+                    if kind != None and not kind in targets.setdefault(node.name, []):
+                        targets[node.name].append(kind)
+                    node = node.parent
+                if hasVertexAnimation(obj, options):
+                    targets.setdefault(obj.name, []).append('points')
+    return targets
+
+def quantize(value, step):
+    if step > 0.0:
+        return round(round(value/step)*step, 6)
+    return round(value, 6)
+
+def getDeformedPoints(obj, options):
+    mesh = obj.to_mesh(bpy.context.scene, True, 'PREVIEW')
+    step = options['vertexQuantization']
+    points = [tuple(quantize(f, step) for f in v.co) for v in mesh.vertices]
+    bpy.data.meshes.remove(mesh)
+    return points
+
+def eliminateConstantSamples(samples):
+    # USD interpolates between samples and holds the first and last one, so only
+    # the frames bordering a change are kept
+    kept = []
+    for i, sample in enumerate(samples):
+        if (i > 0 and sample[1] != samples[i-1][1]) or (i < len(samples)-1 and sample[1] != samples[i+1][1]):
+            kept.append(sample)
+    if len(kept) == 0:
+        return samples[:1]
+    return kept
+
+def exportPointSamples(obj, count, options):
+    # Only the points are animated, the normals keep their rest pose values
+    samples = options['frameSamples'].get(obj.name, {}).get('points', [])
+    if len(samples) > 0 and all(len(points) == count for frame, points in samples):
+        samples = eliminateConstantSamples(samples)
+        if len(samples) > 1:
+            return samples
+    return None
+
+def getAnimationFrames(options):
+    return list(range(options['startTimeCode'], options['endTimeCode']+1))
+
+def createFrameSamples(targets):
+    samples = {}
+    for name in targets:
+        samples[name] = {'transforms': [], 'rotations': [], 'scales': [], 'translations': [], 'points': []}
     return samples
 
-def exportLocalTimeSamples(obj, options):
+def sampleFrame(frame, targets, samples, options):
+    bpy.context.scene.frame_set(frame)
+    for name, kinds in targets.items():
+        obj = bpy.data.objects[name]
+        sample = samples[name]
+        if 'skeleton' in kinds:
+            sample['rotations'].append((frame, [bone.rotation_quaternion[:] for bone in obj.pose.bones]))
+            sample['scales'].append((frame, getArmatureScales(obj, options['scale'])))
+            sample['translations'].append((frame, getArmatureTranslations(obj, options['scale'])))
+        if 'root' in kinds:
+            sample['transforms'].append((frame, exportRootMatrix(obj.matrix_world, options)))
+        if 'local' in kinds:
+            sample['transforms'].append((frame, exportMatrix(obj.matrix_local)))
+        if 'points' in kinds:
+            sample['points'].append((frame, getDeformedPoints(obj, options)))
+
+def sampleFrames(targets, frames, options):
+    # Every animated object is sampled in a single pass over the frames
+    samples = createFrameSamples(targets)
     originalFrame = bpy.context.scene.frame_current
-    frame_begin = options['startTimeCode']
-    frame_end = options['endTimeCode']
-    samples = []
-    for frame in range(frame_begin, frame_end+1):
-        bpy.context.scene.frame_set(frame)
-        samples.append((frame, exportMatrix(obj.matrix_local)))
-    bpy.context.scene.frame_set(originalFrame)
+    try:
+        for frame in frames:
+            checkCancelled(options)
+            sampleFrame(frame, targets, samples, options)
+    finally:
+        bpy.context.scene.frame_set(originalFrame)
     return samples
 
-def exportTimeSamples(obj, options):
-    if options['animated'] and obj.type != 'ARMATURE':
-        if obj.parent == None:
-            return exportRootTimeSamples(obj, options)
-        elif obj.parent.type != 'ARMATURE':
-            return exportLocalTimeSamples(obj, options)
-    return []
+def useSamplingWorkers(targets, frames, options):
+    return options['animationWorkers'] > 1 and len(frames) > 1 and len(targets) > 0
+
+def getFrameSlices(frames, count):
+    size = (len(frames) + count - 1)//count
+    return [frames[i:i+size] for i in range(0, len(frames), size)]
+
+def getAutoExecArgument():
+    # Workers only run the file's scripts and drivers if this session trusts them too
+    if bpy.context.user_preferences.system.use_scripts_auto_execute and not bpy.app.autoexec_fail:
+        return '--enable-autoexec'
+    return '--disable-autoexec'
+
+def startSamplingWorkers(targets, frames, options):
+    # Each worker samples a contiguous slice of frames from a copy of the scene
+    samplingPath = options['tempPath'] + 'sampling/'
+    os.mkdir(samplingPath)
+    blendFile = samplingPath + 'scene.blend'
+    bpy.ops.wm.save_as_mainfile(filepath=blendFile, copy=True)
+    
+    addonPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    autoExec = getAutoExecArgument()
+    workers = []
+    for i, frameSlice in enumerate(getFrameSlices(frames, options['animationWorkers'])):
+        job = {}
+        job['targets'] = targets
+        job['frames'] = frameSlice
+        job['options'] = getPrintOptions(options)
+        job['output'] = samplingPath + 'samples_%d.json' % i
+        jobFile = samplingPath + 'job_%d.json' % i
+        f = open(jobFile, 'w')
+        json.dump(job, f)
+        f.close()
+        
+        expr = 'import sys; sys.path.insert(0, %r); import importlib; importlib.import_module(%r).runSamplingWorker(%r)' % (addonPath, __name__, jobFile)
+        args = [bpy.app.binary_path, '--background', blendFile, autoExec, '--python-expr', expr]
+        workers.append((subprocess.Popen(args, stdout=subprocess.DEVNULL), job['output']))
+    return workers
+
+def collectSamplingWorkers(workers, targets):
+    samples = createFrameSamples(targets)
+    for process, output in workers:
+        if not os.path.exists(output):
+            raise RuntimeError('Animation sampling worker failed')
+        f = open(output, 'r')
+        workerSamples = json.load(f)
+        f.close()
+        for name, sample in workerSamples.items():
+            for key, values in sample.items():
+                samples[name][key] += values
+    return samples
+
+def runSamplingWorker(jobFile):
+    f = open(jobFile, 'r')
+    job = json.load(f, object_pairs_hook=collections.OrderedDict)
+    f.close()
+    samples = sampleFrames(job['targets'], job['frames'], job['options'])
+    f = open(job['output'], 'w')
+    json.dump(samples, f)
+    f.close()
+
+def getUncachedNames(objs, options):
+    # Objects reused from the object cache already hold their samples
+    cache = options['objectCache']
+    names = set()
+    for obj in objs:
+        if obj.type == 'MESH':
+            node = obj
+            while node != None:
+                if node.type == 'ARMATURE':
+                    if not obj.name in cache:
+                        names.add(node.name)
+                elif not node.name in cache:
+                    names.add(node.name)
+                node = node.parent
+    return names
+
+def sampleAnimation(objs, options):
+    targets = getAnimationTargets(objs, options)
+    frames = getAnimationFrames(options)
+    if 'objectCache' in options:
+        names = getUncachedNames(objs, options)
+        targets = collections.OrderedDict((name, kinds) for name, kinds in targets.items() if name in names)
+    if len(targets) == 0:
+        options['frameSamples'] = {}
+    elif useSamplingWorkers(targets, frames, options):
+        workers = startSamplingWorkers(targets, frames, options)
+        waitProcesses([process for process, output in workers], options)
+        options['frameSamples'] = collectSamplingWorkers(workers, targets)
+    else:
+        options['frameSamples'] = sampleFrames(targets, frames, options)
 
 def exportObject(obj, options):
     object = {}
@@ -422,17 +956,30 @@ def exportEmpty(obj, options):
     object['timeSamples'] = exportTimeSamples(obj, options)
     return object
 
-def exportObjects(objs, options):
-    objMap = {}
-    for obj in objs:
-        if obj.type == 'MESH':
-            objMap[obj.name] = exportObject(obj, options)
-            parent = obj.parent
-            while parent != None and parent.type != 'ARMATURE':
-                if not parent.name in objMap :
-                    objMap[parent.name] = exportEmpty(parent, options)
-                parent = parent.parent
-    selectObjects(objs)
+def exportCached(obj, exporter, options):
+    if not 'objectCache' in options:
+        return exporter(obj, options)
+    if not obj.name in options['objectCache']:
+        options['objectCache'][obj.name] = exporter(obj, options)
+    return options['objectCache'][obj.name]
+
+def getMeshNames(objs):
+    return set(obj.name for obj in objs if obj.type == 'MESH')
+
+def exportObjectTree(obj, objMap, meshNames, options):
+    if not obj.name in objMap:
+        objMap[obj.name] = exportCached(obj, exportObject, options)
+    parent = obj.parent
+    while parent != None and parent.type != 'ARMATURE':
+        if not parent.name in objMap :
+            # Exported parents keep their meshes, the cache holds one entry per name
+            exporter = exportObject if parent.name in meshNames else exportEmpty
+            objMap[parent.name] = exportCached(parent, exporter, options)
+        parent = parent.parent
+
+def linkObjects(objMap):
+    for object in objMap.values():
+        object['children'] = []
     for name, object in objMap.items():
         if object['parent'] != None:
             parent = objMap[object['parent']]
@@ -443,6 +990,16 @@ def exportObjects(objs, options):
             objects.append(object)
     return objects
 
+def exportObjects(objs, options):
+    sampleAnimation(objs, options)
+    objMap = collections.OrderedDict()
+    meshNames = getMeshNames(objs)
+    for i, obj in enumerate(objs):
+        if obj.type == 'MESH':
+            exportObjectTree(obj, objMap, meshNames, options)
+        reportProgress(options, exportPhases[1], (i+1)/len(objs))
+    return linkObjects(objMap)
+
 
 
 
@@ -472,6 +1029,7 @@ def getDefaultMaterial():
     mat['roughnessMap'] = None
     mat['specular'] = (1.0, 1.0, 1.0)
     mat['specularWorkflow'] = False
+    mat['aliases'] = []
     return mat
 
 
@@ -482,89 +1040,125 @@ def getOutputMaterialNode(mat):
     return None
 
 def getSurfaceShaderNode(mat):
-    node = getOutputMaterialNode(mat)
-    if node != None and 'Surface' in node.inputs.keys() and node.inputs['Surface'].is_linked:
-        return node.inputs['Surface'].links[0].from_node
-    return None
-
-def exportInputImage(input, fileName, options):
+    key = mat.as_pointer()
+    if not key in shaderNodes:
+        shaderNodes[key] = None
+        node = getOutputMaterialNode(mat)
+        if node != None and 'Surface' in node.inputs.keys() and node.inputs['Surface'].is_linked:
+            shaderNodes[key] = node.inputs['Surface'].links[0].from_node
+    return shaderNodes[key]
+
+def getInputImage(input):
     if input.is_linked and len(input.links) > 0:
         for link in input.links:
             node = link.from_node
             if node.type == 'TEX_IMAGE' and node.image != None:
-                filePath = options['tempPath'] + fileName
-                saveImage(node.image, filePath)
-                return fileName
+                return node.image
     return None
 
-def exportPrincipledBSDF(node, name, options):
+def exportPrincipledBSDF(node, name):
     mat = getDefaultMaterial()
     mat['name'] = name
     mat['clearcoat'] = node.inputs['Clearcoat'].default_value
     mat['clearcoatRoughness'] = node.inputs['Clearcoat Roughness'].default_value
     mat['color'] = node.inputs['Base Color'].default_value[:]
-    mat['colorMap'] = exportInputImage(node.inputs['Base Color'], name+'_color.png', options)
+    mat['colorMap'] = getInputImage(node.inputs['Base Color'])
     mat['metallic'] = node.inputs['Metallic'].default_value
-    mat['metallicMap'] = exportInputImage(node.inputs['Metallic'], name+'_metallic.png', options)
+    mat['metallicMap'] = getInputImage(node.inputs['Metallic'])
     mat['ior'] = node.inputs['IOR'].default_value
     mat['roughness'] = node.inputs['Roughness'].default_value
-    mat['roughnessMap'] = exportInputImage(node.inputs['Roughness'], name+'_roughness.png', options)
-    mat['normalMap'] = exportInputImage(node.inputs['Normal'], name+'_normal.png', options)
+    mat['roughnessMap'] = getInputImage(node.inputs['Roughness'])
+    mat['normalMap'] = getInputImage(node.inputs['Normal'])
     return mat
 
-def exportDiffuseBSDF(node, name, options):
+def exportDiffuseBSDF(node, name):
     mat = getDefaultMaterial()
     mat['name'] = name
     mat['color'] = node.inputs['Color'].default_value[:]
-    mat['colorMap'] = exportInputImage(node.inputs['Color'], name+'_color.png', options)
+    mat['colorMap'] = getInputImage(node.inputs['Color'])
     mat['roughness'] = node.inputs['Roughness'].default_value
-    mat['roughnessMap'] = exportInputImage(node.inputs['Roughness'], name+'_roughness.png', options)
-    mat['normalMap'] = exportInputImage(node.inputs['Normal'], name+'_normal.png', options)
+    mat['roughnessMap'] = getInputImage(node.inputs['Roughness'])
+    mat['normalMap'] = getInputImage(node.inputs['Normal'])
     return mat
 
-def exportCyclesMaterial(material, options):
+def exportCyclesMaterial(material):
     mat = getDefaultMaterial()
+    name = material.name.replace('.', '_')
     node = getSurfaceShaderNode(material)
     if node != None:
         if node.type == 'BSDF_PRINCIPLED':
-            mat = exportPrincipledBSDF(node, material.name, options)
+            mat = exportPrincipledBSDF(node, name)
         elif node.type == 'BSDF_DIFFUSE':
-            mat = exportDiffuseBSDF(node, material.name, options)
-    mat['name'] = material.name
+            mat = exportDiffuseBSDF(node, name)
+    mat['name'] = name
     return mat
 
 
-def extractInternalColorMap(mat, options):
+def getInternalColorImage(mat):
     for slot in mat.texture_slots:
         if slot != None and slot.use_map_color_diffuse and slot.texture.type == 'IMAGE' and slot.texture.image != None:
-            fileName = mat.name.replace('.', '_') + '_color.png'
-            filePath = options['tempPath'] + fileName
-            saveImage(slot.texture.image, filePath)
-            return fileName
+            return slot.texture.image
     return None
 
 
-def extractInternalNormalMap(mat, options):
+def getInternalNormalImage(mat):
     for slot in mat.texture_slots:
         if slot != None and slot.use_map_normal and slot.texture.type == 'IMAGE' and slot.texture.image != None:
-            fileName = mat.name.replace('.', '_') + '_normal.png'
-            filePath = options['tempPath'] + fileName
-            saveImage(slot.texture.image, filePath)
-            return fileName
+            return slot.texture.image
     return None
 
 
-def exportInternalMaterial(mat, options):
+def exportInternalMaterial(mat):
     material = getDefaultMaterial()
     material['name'] = mat.name.replace('.', '_')
     material['color'] = mat.diffuse_color[:] + (1.0,)
-    material['colorMap'] = extractInternalColorMap(mat, options)
+    material['colorMap'] = getInternalColorImage(mat)
     material['emissive'] = tuple([mat.emit*s for s in mat.diffuse_color[:]]) + (1.0,)
-    material['normalMap'] = extractInternalNormalMap(mat, options)
+    material['normalMap'] = getInternalNormalImage(mat)
     material['specular'] = mat.specular_color[:]
     return material
 
 
+def getImageSource(img):
+    if img.source == 'FILE' and img.packed_file == None:
+        return bpy.path.abspath(img.filepath)
+    return img.name
+
+
+def getMaterialFingerprint(mat):
+    fingerprint = hashlib.sha1()
+    for key in sorted(mat.keys()):
+        value = mat[key]
+        if key in materialImageFiles and value != None:
+            value = getImageSource(value)
+        if key != 'name' and key != 'aliases':
+            fingerprint.update(repr((key, value)).encode())
+    return fingerprint.hexdigest()
+
+
+def getPassthroughFile(img):
+    # Unmodified 8 bit PNG and JPEG files are packaged as they are on disk
+    if img.source == 'FILE' and img.packed_file == None and not img.is_dirty and not img.is_float:
+        if img.file_format in passthroughFormats:
+            filePath = bpy.path.abspath(img.filepath)
+            if os.path.isfile(filePath):
+                return filePath
+    return None
+
+
+def exportMaterialImages(mat, options):
+    for key, suffix in materialImageFiles.items():
+        if mat[key] != None:
+            sourceFile = getPassthroughFile(mat[key])
+            if sourceFile != None:
+                fileName = mat['name'] + suffix + passthroughFormats[mat[key].file_format]
+                shutil.copyfile(sourceFile, options['tempPath'] + fileName)
+            else:
+                fileName = mat['name'] + suffix + '.png'
+                saveImage(mat[key], options['tempPath'] + fileName)
+            mat[key] = fileName
+
+
 def bakeAO(obj, file, options):
     if len(obj.data.uv_textures) > 0:
         # Create an image
@@ -592,381 +1186,716 @@ def bakeAO(obj, file, options):
     return None
 
 
-def exportMaterial(mat, options):
+def exportMaterial(mat):
     if mat != None:
         if mat.use_nodes:
-            return exportCyclesMaterial(mat, options)
-        return exportInternalMaterial(mat, options)
+            return exportCyclesMaterial(mat)
+        return exportInternalMaterial(mat)
     return getDefaultMaterial()
 
 
-def exportMaterials(objs, options):
-    materialNames = set()
-    materials = []
-    
-    for obj in objs:
-        if obj.type == 'MESH' and len(obj.data.materials) > 0:
-            aoMap = None
-            if options['bakeAO']:
+def createMaterialLibrary(cache = None):
+    library = {}
+    library['materials'] = []
+    library['names'] = set()
+    library['fingerprints'] = {}
+    library['cache'] = cache
+    return library
+
+
+def exportObjectMaterials(obj, library, options):
+    if obj.type == 'MESH' and len(obj.data.materials) > 0:
+        aoMap = None
+        if options['bakeAO']:
+            # Objects served from the watch caches keep their baked texture
+            aoCache = options.get('aoCache', {})
+            if obj.name in aoCache:
+                aoMap = aoCache[obj.name]
+            else:
                 aoFile = obj.data.materials[0].name.replace('.', '_') + '_ao.png'
                 aoMap = bakeAO(obj, aoFile, options)
-            
-            for mat in obj.data.materials:
-                if mat != None:
-                    name = mat.name.replace('.', '_')
-                    if not name in materialNames:
-                        materialNames.add(name)
-                        materials.append(exportMaterial(mat, options))
-                        materials[-1]['occlusionMap'] = aoMap
-    if len(materials) == 0:
-        materials.append(getDefaultMaterial())
-    return materials
+                if 'aoCache' in options:
+                    aoCache[obj.name] = aoMap
+        
+        for mat in obj.data.materials:
+            if mat != None:
+                name = mat.name.replace('.', '_')
+                if not name in library['names']:
+                    library['names'].add(name)
+                    material = exportMaterial(mat)
+                    material['occlusionMap'] = aoMap
+                    
+                    # Collapse materials with identical parameters and textures
+                    fingerprint = getMaterialFingerprint(material)
+                    if fingerprint in library['fingerprints']:
+                        library['fingerprints'][fingerprint]['aliases'].append(name)
+                    else:
+                        material = exportCachedMaterialImages(material, fingerprint, library, options)
+                        library['fingerprints'][fingerprint] = material
+                        library['materials'].append(material)
+
+
+def exportCachedMaterialImages(material, fingerprint, library, options):
+    # Materials with an unchanged fingerprint reuse the textures already written
+    cache = library['cache']
+    if cache == None:
+        exportMaterialImages(material, options)
+        return material
+    if not fingerprint in cache:
+        exportMaterialImages(material, options)
+        cache[fingerprint] = material
+    cached = dict(cache[fingerprint])
+    cached['name'] = material['name']
+    cached['aliases'] = []
+    return cached
+
+
+def getLibraryMaterials(library):
+    if len(library['materials']) == 0:
+        return [getDefaultMaterial()]
+    return library['materials']
+
+
+def exportMaterials(objs, options, cache = None):
+    library = createMaterialLibrary(cache)
+    
+    for i, obj in enumerate(objs):
+        exportObjectMaterials(obj, library, options)
+        reportProgress(options, exportPhases[2], (i+1)/len(objs))
+    return getLibraryMaterials(library)
 
 
+def iterMeshes(objs):
+    for obj in objs:
+        for mesh in iterMeshes(obj['children']):
+            yield mesh
+        for mesh in obj['meshes']:
+            yield mesh
 
-################################################################################
-##                          USDA Export Methods                               ##
-################################################################################
 
-def getJointIndices(vertexWeights, elements):
-    collection = []
-    for v in vertexWeights:
-        indices = elements*[0]
-        for i, g in enumerate(v[:elements]):
-            indices[i] = g[0]
-        collection += indices
-    return collection
-
-def printJointIndices(vertexWeights, elements):
-    indices = getJointIndices(vertexWeights, elements)
-    src = 2*tab + 'int[] primvars:skel:jointIndices = [' + printIndices(indices) + '] (\n'
-    src += 3*tab + 'elementSize = %d\n' %elements
-    src += 3*tab + 'interpolation = "vertex"\n'
-    src += 2*tab + ')\n'
-    return src
+def bindMaterials(objs, materials):
+    # Remap mesh bindings from collapsed materials to the material kept
+    bindings = {}
+    for mat in materials:
+        for alias in mat.get('aliases', []):
+            bindings[alias] = mat['name']
+    for mesh in iterMeshes(objs):
+        mesh['binding'] = bindings.get(mesh['material'], mesh['material'])
 
-def getJointWeights(vertexWeights, elements):
-    collection = []
-    for v in vertexWeights:
-        weights = elements*[0]
-        for i, g in enumerate(v[:elements]):
-            weights[i] = g[1]
-        collection += weights
-    return collection
-
-def printJointWeights(vertexWeights, elements):
-    weights = getJointWeights(vertexWeights, elements)
-    src = 2*tab + 'float[] primvars:skel:jointWeights = [' + printTuple(weights) + '] (\n'
-    src += 3*tab + 'elementSize = %d\n' %elements
-    src += 3*tab + 'interpolation = "vertex"\n'
-    src += 2*tab + ')\n'
-    return src
 
-def printMesh(mesh, options, indent):
-    src = indent + tab + 'def Mesh "' + mesh['name'] + '"\n'
-    src += indent + tab + '{\n'
-    src += indent + 2*tab + 'float3[] extent = [' + printVectors(mesh['extent']) + ']\n'
-    src += indent + 2*tab + 'int[] faceVertexCounts = [' + printIndices(mesh['faceVertexCounts']) + ']\n'
-    src += indent + 2*tab + 'int[] faceVertexIndices = [' + printIndices(mesh['faceVertexIndices']) + ']\n'
-    if options['exportMaterials']:
-        src += indent + 2*tab + 'rel material:binding = </Materials/' + mesh['material'] + '>\n'
-    src += indent + 2*tab + 'point3f[] points = [' + printVectors(mesh['points']) + ']\n'
-    src += indent + 2*tab + 'normal3f[] primvars:normals = [' + printVectors(mesh['normals']) + '] (\n'
-    src += indent + 3*tab + 'interpolation = "vertex"\n'
-    src += indent + 2*tab + ')\n'
-    src += indent + 2*tab + 'int[] primvars:normals:indices = [' + printIndices(mesh['normalIndices']) + ']\n'
-    src += indent + 2*tab + 'texCoord2f[] primvars:Texture_uv = [' + printVectors(mesh['uvs']) + '] (\n'
-    src += indent + 3*tab + 'interpolation = "faceVarying"\n'
-    src += indent + 2*tab + ')\n'
-    src += indent + 2*tab + 'int[] primvars:Texture_uv:indices = [' + printIndices(mesh['uvIndices']) + ']\n'
-    if mesh['weights'] != None:
-        src += printJointIndices(mesh['weights'], 4)
-        src += printJointWeights(mesh['weights'], 4)
-    if mesh['skeleton'] != None and mesh['animationSource'] != None:
-        src += indent + 2*tab + 'prepend rel skel:animationSource = <' + mesh['animationSource'] + '>\n'
-        src += indent + 2*tab + 'prepend rel skel:skeleton = <' + mesh['skeleton'] + '>\n'
-    src += indent + 2*tab + 'uniform token subdivisionScheme = "none"\n'
-    src += indent + tab + '}\n'
-    src += indent + tab + '\n'
-    return src
 
-def printMeshes(meshes, options, indent):
-    src = ''
-    for mesh in meshes:
-        src += printMesh(mesh, options, indent)
-    return src
+################################################################################
+##                          USDZ Export Methods                               ##
+################################################################################
 
-def printSkeleton(skeleton, options, indent):
-    src = indent + tab + 'def Skeleton "' + skeleton['name'] + '"\n'
-    src += indent + tab + '{\n'
-    src += indent + 2*tab + 'uniform token[] joints = [' + ', '.join('"' + t + '"' for t in skeleton['jointTokens']) + ']\n'
-    src += indent + 2*tab + 'uniform matrix4d[] bindTransforms = [' + ', '.join('(' + printVectors(m) + ')' for m in skeleton['bindTransforms']) + ']\n'
-    src += indent + 2*tab + 'uniform matrix4d[] restTransforms = [' + ', '.join('(' + printVectors(m) + ')' for m in skeleton['restTransforms']) + ']\n'
-    src += indent + tab + '}\n'
-    return src
+def writeUSDZ(materials, options):
+    usdaFile = options['tempPath'] + options['fileName'] + '.usda'
+    usdzFile = options['tempPath'] + options['fileName'] + '.usdz'
+    
+    args = ['xcrun', 'usdz_converter', usdaFile, usdzFile]
+    args += ['-v']
+    
+    if options['exportMaterials']:
+        for mat in materials:
+            mArgs = []
+            if mat['colorMap'] != None:
+                mArgs += ['-color_map', mat['colorMap']]
+            if mat['normalMap'] != None:
+                mArgs += ['-normal_map', mat['normalMap']]
+            if mat['occlusionMap'] != None:
+                mArgs += ['-ao_map', mat['occlusionMap']]
+            # Add Material Arguments if any
+            if len(mArgs) > 0:
+                args += ['-m', '/Materials/' + mat['name']] + mArgs 
+    runProcess(args, options)
+    
+    # Move the package into place only once it is complete
+    if os.path.exists(usdzFile):
+        replaceFile(usdzFile, options['basePath'] + options['fileName'] + '.usdz')
 
-def printTimeSamples(samples, indent):
-    src = ''
-    for sample in samples:
-        src += indent + 3*tab + '%d: [' % sample[0] + printVectors(sample[1]) + '],\n'
-    return src
 
-def printSkelAnimation(animation, options, indent):
-    src = indent + tab + 'def SkelAnimation "' + animation['name'] + '"\n'
-    src += indent + tab + '{\n'
-    src += indent + 2*tab + 'uniform token[] joints = [' + ', '.join('"' + t + '"' for t in animation['jointTokens']) + ']\n'
-    src += indent + 2*tab + 'quatf[] rotations.timeSamples = {\n' + printTimeSamples(animation['rotations'], indent)
-    src += indent + 2*tab + '}\n'
-    src += indent + 2*tab + 'half3[] scales.timeSamples = {\n' + printTimeSamples(animation['scales'], indent)
-    src += indent + 2*tab + '}\n'
-    src += indent + 2*tab + 'float3[] translations.timeSamples = {\n' + printTimeSamples(animation['translations'], indent)
-    src += indent + 2*tab + '}\n'
-    src += indent + tab + '}\n'
-    return src
 
-def printMatrix(mtx):
-    return 'custom matrix4d xformOp:transform = (' + printVectors(mtx) + ')'
+################################################################################
+##                           USD Export Methods                               ##
+################################################################################
 
-def printTimeTransforms(timeCodes, indent):
-    src = indent + tab + 'matrix4d xformOp:transform:transforms.timeSamples = {\n'
-    for time, mtx in timeCodes:
-        src += indent + 2*tab + '%d: (' % time + printVectors(mtx) + '),\n'
-    src += indent + tab + '}\n'
-    src += indent + tab + 'uniform token[] xformOpOrder = ["xformOp:transform:transforms"]\n'
-    return src
+def beginExport(options):
+    # Stage all intermediate files in a temp directory
+    options['tempDir'] = tempfile.mkdtemp()
+    options['tempPath'] = options['tempDir'] + '/'
+    updateSceneOptions(options)
 
-def printTimeCodes(animation):
-    src = '(\n'
-    src += tab + 'endTimeCode = %d\n' % animation['endTimeCode']
-    src += tab + 'startTimeCode = %d\n' % animation['startTimeCode']
-    src += tab + 'timeCodesPerSecond = %d\n' % animation['timeCodesPerSecond']
-    return src + ')\n'
 
-def printRigidObject(obj, options, indent):
-    src = indent + 'def Xform "' + obj['name'] + '"\n'
-    src += indent + '{\n'
-    if options['animated']:
-        src += printTimeTransforms(obj['timeSamples'], indent)
-    else:
-        src += indent + tab + printMatrix(obj['matrix']) + '\n'
-        src += indent + tab + 'uniform token[] xformOpOrder = ["xformOp:transform"]\n'
-    src += indent + tab + '\n'
-    if len(obj['children']):
-        src += printObjects(obj['children'], options, indent + tab)
-        src += indent + tab + '\n'
-    src += printMeshes(obj['meshes'], options, indent)
-    src += indent + '}\n\n'
-    return src
+def updateSceneOptions(options):
+    options['startTimeCode'] = bpy.context.scene.frame_start
+    options['endTimeCode'] = bpy.context.scene.frame_end
+    options['timeCodesPerSecond'] = bpy.context.scene.render.fps
+    shaderNodes.clear()
 
-def printSkinnedObject(obj, options, indent):
-    src = indent + 'def SkelRoot "' + obj['name'] + '"\n'
-    src += indent + '{\n'
-    src += printMeshes(obj['meshes'], options, indent)
-    src += printSkeleton(obj['skeleton'], options, indent)
-    src += indent + tab + '\n'
-    src += printSkelAnimation(obj['animation'], options, indent)
-    src += indent + '}\n\n'
-    return src
 
-def printObjects(objs, options, indent):
-    src = ''
-    for obj in objs:
-        if obj['skeleton'] == None:
-            src += printRigidObject(obj, options, indent)
-        else:
-            src += printSkinnedObject(obj, options, indent)
-    return src
+def keepFiles(options):
+    # Copy the image files and only the USDA layers written for this output
+    for fileName in os.listdir(options['tempDir']):
+        if os.path.isfile(options['tempPath'] + fileName) and not fileName.endswith('.usdz'):
+            if not fileName.endswith('.usda') or fileName in options.get('usdaFiles', []):
+                shutil.copyfile(options['tempPath'] + fileName, options['basePath'] + fileName)
 
 
-def printPbrShader(mat):
-    src = 2*tab + 'def Shader "pbr"\n'
-    src += 2*tab + '{\n'
-    src += 3*tab + 'uniform token info:id = "UsdPreviewSurface"\n'
-    src += 3*tab + 'float inputs:clearcoat = %.6g\n' % mat['clearcoat']
-    src += 3*tab + 'float inputs:clearcoatRoughness = %.6g\n' % mat['clearcoatRoughness']
+def endExport(options, completed):
+    # Keep the generated USDA and image files if requested
+    if completed and options['keepUSDA']:
+        keepFiles(options)
     
-    if mat['colorMap'] == None:
-        src += 3*tab + 'color3f inputs:diffuseColor = (' + printTuple(mat['color'][:3]) + ')\n'
+    # Cleanup Temp Directory
+    shutil.rmtree(options['tempDir'], ignore_errors=True)
+    shaderNodes.clear()
+
+
+def writeUSD(objects, materials, options, printed = None):
+    reportProgress(options, exportPhases[3], 0.0)
+    instanceMeshes(objects, '', {})
+    bindMaterials(objects, materials)
+    if options['layered']:
+        writeLayeredUSDA(objects, materials, options)
     else:
-        src += 3*tab + 'color3f inputs:diffuseColor.connect = </Materials/' + mat['name'] + '/color_map.outputs:rgb>\n'
+        writeUSDA(objects, materials, options, printed)
+    reportProgress(options, exportPhases[4], 0.0)
+    writeUSDZ(materials, options)
+    reportProgress(options, exportPhases[4], 1.0)
+
+
+def usePipeline(options):
+    # Layers are printed whole by the workers, so only single files are pipelined
+    return options['pipelined'] and not options['layered']
+
+def getObjectIndent(object, objMap):
+    indent = ''
+    while object['parent'] != None:
+        object = objMap[object['parent']]
+        indent += tab
+    return indent
+
+def consumePrims(prims, printed, errors, pool, options):
+    # Print queued prims until the end marker, each consumer keeps one task in the pool
+    printOptions = getPrintOptions(options)
+    while True:
+        prim = prims.get()
+        if prim == None:
+            return
+        if len(errors) == 0:
+            kind, data, indent = prim
+            try:
+                if pool != None:
+                    src = waitResult(pool.apply_async(printPrim, ((kind, data, indent, printOptions),)), options)
+                else:
+                    src = printPrim((kind, data, indent, printOptions))
+                printed[(id(data), indent)] = src
+            except Exception as e:
+                errors.append(e)
+
+def putPrim(prims, prim, errors, options):
+    # Wait for room in the queue without missing a cancel or a failed consumer
+    while True:
+        checkCancelled(options)
+        if len(errors) > 0:
+            raise errors[0]
+        try:
+            prims.put(prim, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def exportPipelined(objs, options):
+    # Extract objects on this thread while consumers print the ones already extracted
+    sampleAnimation(objs, options)
+    library = createMaterialLibrary()
+    objMap = collections.OrderedDict()
+    meshNames = getMeshNames(objs)
+    printed = {}
+    errors = []
+    fingerprints = set()
     
-    if mat['emissiveMap'] == None:
-        src += 3*tab + 'color3f inputs:emissiveColor = (' + printTuple(mat['emissive'][:3]) + ')\n'
-    else:
-        src += 3*tab + 'color3f inputs:emissiveColor.connect = </Materials/' + mat['name'] + '/emissive_map.outputs:rgb>\n'
+    workers = getWorkerCount(options)
+    pool = None
+    if workers > 1:
+        context = getProcessContext(options)
+        if context != None:
+            pool = startPool(context, workers)
+    prims = queue.Queue(2*workers)
+    consumers = [threading.Thread(target=consumePrims, args=(prims, printed, errors, pool, options)) for i in range(workers)]
+    for consumer in consumers:
+        consumer.start()
     
-    src += 3*tab + 'float inputs:displacement = %.6g\n' % mat['displacement']
-    src += 3*tab + 'float inputs:ior = %.6g\n' % mat['ior']
+    completed = False
+    try:
+        for i, obj in enumerate(objs):
+            checkCancelled(options)
+            if len(errors) > 0:
+                raise errors[0]
+            if obj.type == 'MESH':
+                exportObjectTree(obj, objMap, meshNames, options)
+            exportObjectMaterials(obj, library, options)
+            if obj.type == 'MESH':
+                object = objMap[obj.name]
+                indent = getObjectIndent(object, objMap)
+                bindMaterials([object], getLibraryMaterials(library))
+                for mesh in object['meshes']:
+                    # Repeated geometry becomes an instance, which is cheap to print later
+                    if isInstanceable(mesh):
+                        if mesh['fingerprint'] in fingerprints:
+                            continue
+                        fingerprints.add(mesh['fingerprint'])
+                    putPrim(prims, ('mesh', mesh, indent), errors, options)
+                if object['animation'] != None:
+                    putPrim(prims, ('animation', object['animation'], indent), errors, options)
+            reportProgress(options, exportPhases[1], (i+1)/len(objs))
+        completed = True
+    finally:
+        for consumer in consumers:
+            prims.put(None)
+        for consumer in consumers:
+            consumer.join()
+        if pool != None:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return (linkObjects(objMap), getLibraryMaterials(library), printed)
+
+def exportUSD(objs, options):
+    beginExport(options)
+    completed = False
+    try:
+        if usePipeline(options):
+            objects, materials, printed = exportPipelined(objs, options)
+            writeUSD(objects, materials, options, printed)
+        else:
+            objects = exportObjects(objs, options)
+            materials = exportMaterials(objs, options)
+            writeUSD(objects, materials, options)
+        completed = True
+    finally:
+        endExport(options, completed)
+
+
+
+################################################################################
+##                         Budget Estimate Methods                            ##
+################################################################################
+
+def getObjectImages(obj, options):
+    images = []
+    if options['exportMaterials']:
+        for mat in obj.data.materials:
+            if mat != None:
+                material = exportMaterial(mat)
+                images += [material[key] for key in materialImageFiles if material[key] != None]
+    return images
+
+
+def estimateObject(obj, images, options):
+    frames = bpy.context.scene.frame_end - bpy.context.scene.frame_start + 1
     
-    if mat['metallicMap'] == None:
-        src += 3*tab + 'float inputs:metallic = %.6g\n' % mat['metallic']
-    else:
-        src += 3*tab + 'float inputs:metallic.connect = </Materials/' + mat['name'] + '/metallic_map.outputs:r>\n'
+    # Count the evaluated mesh the export writes, modifiers can multiply the geometry
+    data = getEvaluatedMesh(obj)
+    vertices = len(data.vertices)
+    loops = len(data.loops)
+    polygons = len(data.polygons)
+    bpy.data.meshes.remove(data)
     
-    if mat['normalMap'] == None:
-        src += 3*tab + 'normal3f inputs:normal = (0, 0, 1)\n'
-    else:
-        src += 3*tab + 'normal3f inputs:normal.connect = </Materials/' + mat['name'] + '/normal_map.outputs:rgb>\n'
+    estimate = collections.OrderedDict()
+    estimate['name'] = obj.name
+    estimate['vertices'] = vertices
+    estimate['faceVaryingElements'] = loops
+    estimate['joints'] = 0
+    estimate['timeSamples'] = 0
+    estimate['texturePixels'] = 0
     
-    if mat['occlusionMap'] == None:
-        src += 3*tab + 'float inputs:occlusion = 0\n'
-    else:
-        src += 3*tab + 'float inputs:occlusion.connect = </Materials/' + mat['name'] + '/ao_map.outputs:r>\n'
+    scalars = 3*vertices + polygons + 4*loops
+    if options['exportMaterials']:
+        scalars += 3*loops
+    arm = obj.parent
+    if arm != None and arm.type == 'ARMATURE':
+        estimate['joints'] = len(arm.data.bones)
+        estimate['timeSamples'] = 3*frames*len(arm.data.bones)
+        scalars += 2*options['maxInfluences']*vertices + 10*frames*len(arm.data.bones)
+    elif options['animated']:
+        estimate['timeSamples'] = frames
+        scalars += 16*frames
+    if hasVertexAnimation(obj, options):
+        estimate['timeSamples'] += frames
+        scalars += 3*frames*vertices
     
-    if mat['roughnessMap'] == None:
-        src += 3*tab + 'float inputs:roughness = %.6g\n' % mat['roughness']
-    else:
-        src += 3*tab + 'float inputs:roughness.connect = </Materials/' + mat['name'] + '/roughness_map.outputs:r>\n'
-    
-    src += 3*tab + 'float inputs:opacity = %.6g\n' % mat['opacity']
-    src += 3*tab + 'color3f inputs:specularColor = (' + printTuple(mat['specular']) + ')\n'
-    src += 3*tab + 'int inputs:useSpecularWorkflow = %i\n' % int(mat['specularWorkflow'])
-    src += 3*tab + 'token outputs:displacement\n'
-    src += 3*tab + 'token outputs:surface\n'
-    src += 2*tab + '}\n'
-    src += 2*tab + '\n'
+    for img in images:
+        estimate['texturePixels'] += img.size[0]*img.size[1]
+    if options['bakeAO'] and len(obj.data.uv_textures) > 0:
+        estimate['texturePixels'] += 1024*1024
+    estimate['bytes'] = bytesPerScalar*scalars + bytesPerPixel*estimate['texturePixels']
+    return estimate
+
+
+def estimateUSDZ(objs, options):
+    objects = []
+    total = collections.OrderedDict((key, 0) for key in arBudgets)
+    total['name'] = 'Total'
+    imageSources = set()
+    for obj in objs:
+        if obj.type == 'MESH':
+            # Textures shared between objects are only counted once
+            images = []
+            for img in getObjectImages(obj, options):
+                if not getImageSource(img) in imageSources:
+                    imageSources.add(getImageSource(img))
+                    images.append(img)
+            estimate = estimateObject(obj, images, options)
+            objects.append(estimate)
+            for key in arBudgets:
+                total[key] += estimate[key]
+    total['joints'] = max([estimate['joints'] for estimate in objects] + [0])
+    
+    overBudget = [key for key, budget in arBudgets.items() if total[key] > budget]
+    return {'objects': objects, 'total': total, 'overBudget': overBudget}
+
+
+def printEstimate(estimate):
+    src = estimate['name'] + ': '
+    src += ', '.join('%d %s' % (estimate[key], key) for key in arBudgets if key != 'bytes')
+    src += ', ~%d KB' % (estimate['bytes']//1024)
     return src
 
-def printShaderPrimvar(name):
-    src = 2*tab + 'def Shader "Primvar"\n'
-    src += 2*tab + '{\n'
-    src += 3*tab + 'uniform token info:id = "UsdPrimvarReader_float2"\n'
-    src += 3*tab + 'float2 inputs:default = (0, 0)\n'
-    src += 3*tab + 'token inputs:varname.connect = </Materials/' + name + '.inputs:frame:stPrimvarName>\n'
-    src += 3*tab + 'float2 outputs:result\n'
-    src += 2*tab + '}\n'
-    src += 2*tab + '\n'
+
+def printBudgetReport(estimate):
+    src = 'USDZ budget report\n'
+    for obj in estimate['objects']:
+        src += tab + printEstimate(obj) + '\n'
+    src += printEstimate(estimate['total']) + '\n'
+    for key in estimate['overBudget']:
+        src += 'Over budget: %s %d > %d\n' % (key, estimate['total'][key], arBudgets[key])
     return src
 
-def printShaderTexture(compName, matName, default, comps, file):
-    src = 2*tab + 'def Shader "' + compName + '"\n' 
-    src += 2*tab + '{\n'
-    src += 3*tab + 'uniform token info:id = "UsdUVTexture"\n'
-    src += 3*tab + 'float4 inputs:default = (' + printTuple(default) + ')\n'
-    if file != None:
-        src += 3*tab + 'asset inputs:file = @' + file + '@\n'
-    src += 3*tab + 'float2 inputs:st.connect = </Materials/' + matName + '/Primvar.outputs:result>\n'
-    src += 3*tab + 'token inputs:wrapS = "repeat"\n'
-    src += 3*tab + 'token inputs:wrapT = "repeat"\n'
-    if comps == 3:
-        src += 3*tab + 'float3 outputs:rgb\n'
+
+def checkBudget(objs, options, report):
+    # Node references must not outlive the estimate, they go stale on edits and undo
+    shaderNodes.clear()
+    try:
+        estimate = estimateUSDZ(objs, options)
+    finally:
+        shaderNodes.clear()
+    fits = len(estimate['overBudget']) == 0
+    src = printBudgetReport(estimate)
+    if report != None:
+        report({'INFO'} if fits else {'ERROR'}, src)
     else:
-        src += 3*tab + 'float outputs:r\n'
-    src += 2*tab + '}\n'
-    return src
+        print(src)
+    return fits
 
-def printMaterial(mat, options):
-    name = mat['name']
-    
-    src = tab + 'def Material "' + name + '"\n' + tab + '{\n'
-    
-    src += 2*tab + 'token inputs:frame:stPrimvarName = "Texture_uv"\n'
-    src += 2*tab + 'token outputs:displacement.connect = </Materials/' + name + '/pbr.outputs:displacement>\n'
-    src += 2*tab + 'token outputs:surface.connect = </Materials/' + name + '/pbr.outputs:surface>\n'
-    src += 2*tab + '\n'
-    
-    src += printPbrShader(mat)
-    src += printShaderPrimvar(name)
-    
-    if mat['colorMap'] != None:
-        src += printShaderTexture('color_map', name, mat['color'], 3, mat['colorMap']) + '\n'
-    if mat['normalMap'] != None:
-        src += printShaderTexture('normal_map', name, (0, 0, 1, 1), 3, mat['normalMap']) + '\n'
-    if mat['occlusionMap'] != None:
-        src += printShaderTexture('ao_map', name, (0, 0, 0, 1), 1, mat['occlusionMap']) + '\n'
-    if mat['emissiveMap'] != None:
-        src += printShaderTexture('emissive_map', name, mat['emissive'], 3, mat['emissiveMap']) + '\n'
-    if mat['metallicMap'] != None:
-        src += printShaderTexture('metallic_map', name, (mat['metallic'], mat['metallic'], mat['metallic'], 1.0), 1, mat['metallicMap']) + '\n'
-    if mat['roughnessMap'] != None:
-        src += printShaderTexture('roughness_map', name, (mat['roughness'], mat['roughness'], mat['roughness'], 1.0), 1, mat['roughnessMap'])
-    
-    src += tab + '}\n' + tab + '\n'
-    return src
 
-def printMaterials(materials, options):
-    src = ''
-    if options['exportMaterials'] and len(materials) > 0:
-        src += 'def "Materials"\n{\n'
-        for material in materials:
-            src += printMaterial(material, options)
-        src += '}\n\n'
-    return src
 
-def writeUSDA(objs, materials, options):
-    usdaFile = options['tempPath'] + options['fileName'] + '.usda'
-    src = '#usda 1.0\n'
+################################################################################
+##                       Background Export Methods                            ##
+################################################################################
+
+# Export split into steps run from a modal operator's timer. Scene extraction
+# runs one object per step on the main thread, while the USDA serialization and
+# USDZ packaging run on a worker thread.
+class ExportJob:
+    def __init__(self, objs, options):
+        self.options = options
+        self.phase = exportPhases[0]
+        self.progress = 0.0
+        self.cancelled = False
+        self.error = None
+        self.cancelEvent = threading.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        options['cancelEvent'] = self.cancelEvent
+        options['progressCallback'] = self.setProgress
+        self.steps = self.run(objs)
     
-    if options['animated']:
-        src += printTimeCodes(options)
-    src += '\n'
+    def setProgress(self, phase, progress):
+        self.phase = phase
+        self.progress = (exportPhases.index(phase) + progress)/len(exportPhases)
+    
+    def run(self, objs):
+        options = self.options
+        
+        targets = getAnimationTargets(objs, options)
+        frames = getAnimationFrames(options)
+        if useSamplingWorkers(targets, frames, options):
+            workers = startSamplingWorkers(targets, frames, options)
+            while not pollProcesses([process for process, output in workers], options):
+                yield
+            options['frameSamples'] = collectSamplingWorkers(workers, targets)
+        else:
+            options['frameSamples'] = createFrameSamples(targets)
+            originalFrame = bpy.context.scene.frame_current
+            try:
+                for i, frame in enumerate(frames):
+                    sampleFrame(frame, targets, options['frameSamples'], options)
+                    reportProgress(options, exportPhases[0], (i+1)/len(frames))
+                    yield
+            finally:
+                bpy.context.scene.frame_set(originalFrame)
+        
+        objMap = collections.OrderedDict()
+        meshNames = getMeshNames(objs)
+        for i, obj in enumerate(objs):
+            if obj.type == 'MESH':
+                exportObjectTree(obj, objMap, meshNames, options)
+            reportProgress(options, exportPhases[1], (i+1)/len(objs))
+            yield
+        objects = linkObjects(objMap)
+        
+        library = createMaterialLibrary()
+        for i, obj in enumerate(objs):
+            exportObjectMaterials(obj, library, options)
+            reportProgress(options, exportPhases[2], (i+1)/len(objs))
+            yield
+        materials = getLibraryMaterials(library)
+        
+        # Serialize and package off the main thread
+        future = self.executor.submit(writeUSD, objects, materials, options)
+        while not future.done():
+            yield
+        future.result()
     
-    #Add the Objects
-    src += printObjects(objs, options, '')
+    def start(self):
+        beginExport(self.options)
     
-    # Add the Materials
-    src += printMaterials(materials, options)
+    # Returns False once the export has ended
+    def step(self):
+        try:
+            next(self.steps)
+            return True
+        except StopIteration:
+            self.finish(True)
+        except ExportCancelled:
+            self.cancelled = True
+            self.finish(False)
+        except Exception as e:
+            self.error = e
+            self.finish(False)
+        return False
     
-    # Write to file
-    f = open(usdaFile, 'w')
-    f.write(src)
-    f.close()
+    def cancel(self):
+        self.cancelEvent.set()
+    
+    def finish(self, completed):
+        self.executor.shutdown(wait=True)
+        endExport(self.options, completed)
 
 
 
 ################################################################################
-##                          USDZ Export Methods                               ##
+##                          Watch Export Methods                              ##
 ################################################################################
 
-def writeUSDZ(materials, options):
-    usdaFile = options['tempPath'] + options['fileName'] + '.usda'
-    usdzFile = options['basePath'] + options['fileName'] + '.usdz'
+# Re-exports the selection whenever it changes. Extracted objects and
+# materials are cached between exports, so only the changed ones are
+# extracted again once edits have paused for the debounce time.
+class ExportWatcher:
+    def __init__(self, objs, options, debounce):
+        self.objectNames = [obj.name for obj in objs]
+        self.options = options
+        self.debounce = debounce
+        self.materialCache = {}
+        self.dirtyObjects = set()
+        self.dirtyMaterials = False
+        self.lastChange = None
+        self.exporting = False
+        self.ignoreUpdate = False
+        options['objectCache'] = collections.OrderedDict()
+        options['printCache'] = {}
+        options['aoCache'] = {}
     
-    args = ['xcrun', 'usdz_converter', usdaFile, usdzFile]
-    args += ['-v']
+    def start(self):
+        beginExport(self.options)
+        self.startPool()
+        self.refresh()
+        bpy.app.handlers.scene_update_post.append(self.onSceneUpdate)
     
-    if options['exportMaterials']:
-        for mat in materials:
-            mArgs = []
-            if mat['colorMap'] != None:
-                mArgs += ['-color_map', mat['colorMap']]
-            if mat['normalMap'] != None:
-                mArgs += ['-normal_map', mat['normalMap']]
-            if mat['occlusionMap'] != None:
-                mArgs += ['-ao_map', mat['occlusionMap']]
-            # Add Material Arguments if any
-            if len(mArgs) > 0:
-                args += ['-m', '/Materials/' + mat['name']] + mArgs 
-    subprocess.run(args)
+    def stop(self):
+        if self.onSceneUpdate in bpy.app.handlers.scene_update_post:
+            bpy.app.handlers.scene_update_post.remove(self.onSceneUpdate)
+        pool = self.options.pop('printPool', None)
+        if pool != None:
+            pool.terminate()
+            pool.join()
+        endExport(self.options, True)
+    
+    def startPool(self):
+        # One pool prints for the whole session, starting workers on every
+        # refresh would cost more than printing the few changed prims
+        workers = getWorkerCount(self.options)
+        if workers > 1:
+            context = getProcessContext(self.options)
+            if context != None:
+                self.options['printPool'] = startPool(context, workers)
+    
+    def getWatchedObjects(self):
+        # Exported objects and the armatures driving their skins
+        objs = []
+        for name in self.options['objectCache']:
+            obj = bpy.data.objects.get(name)
+            if obj != None:
+                objs.append(obj)
+                if obj.parent != None and obj.parent.type == 'ARMATURE':
+                    objs.append(obj.parent)
+        return objs
+    
+    def recordChanges(self):
+        changed = False
+        for obj in self.getWatchedObjects():
+            if obj.is_updated or obj.is_updated_data:
+                changed = True
+                if obj.type == 'ARMATURE':
+                    self.dirtyObjects.update(child.name for child in obj.children)
+                else:
+                    self.dirtyObjects.add(obj.name)
+        if bpy.data.materials.is_updated or bpy.data.images.is_updated:
+            changed = True
+            self.dirtyMaterials = True
+        return changed
+    
+    def onSceneUpdate(self, scene):
+        if self.exporting:
+            return
+        changed = self.recordChanges()
+        if self.ignoreUpdate:
+            # Updates caused by the export itself
+            self.ignoreUpdate = False
+            self.dirtyObjects.clear()
+            self.dirtyMaterials = False
+            return
+        if changed:
+            self.lastChange = time.time()
+        if self.lastChange != None and time.time() - self.lastChange >= self.debounce:
+            self.lastChange = None
+            try:
+                self.refresh()
+            except Exception as e:
+                print('USDZ watch export failed: ' + str(e))
+    
+    def refresh(self):
+        options = self.options
+        self.exporting = True
+        try:
+            for name in self.dirtyObjects:
+                object = options['objectCache'].pop(name, None)
+                if object != None:
+                    for mesh in object['meshes']:
+                        removeStagedArrays(mesh)
+                options['aoCache'].pop(name, None)
+            if self.dirtyMaterials:
+                self.materialCache.clear()
+            self.dirtyObjects.clear()
+            self.dirtyMaterials = False
+            updateSceneOptions(options)
+            
+            objs = [bpy.data.objects[name] for name in self.objectNames if name in bpy.data.objects]
+            objects = exportObjects(objs, options)
+            materials = exportMaterials(objs, options, self.materialCache)
+            writeUSD(objects, materials, options)
+        finally:
+            self.exporting = False
+            self.ignoreUpdate = True
 
 
 
 ################################################################################
-##                           USD Export Methods                               ##
+##                       Multi Target Export Methods                          ##
 ################################################################################
 
-def exportUSD(objs, options):
-    
-    # Create Temp Directory
-    tempDir = tempfile.mkdtemp()
-    options['tempPath'] = options['basePath']
-    if options['fileType'] == 'usdz' and not options['keepUSDA']:
-        options['tempPath'] = tempDir + '/'
-    
-    options['startTimeCode'] = bpy.context.scene.frame_start
-    options['endTimeCode'] = bpy.context.scene.frame_end
-    options['timeCodesPerSecond'] = bpy.context.scene.render.fps
-    
-    #meshes = exportMeshes(objs, options)
-    objects = exportObjects(objs, options)
-    materials = exportMaterials(objs, options)
-    
-    #writeUSDA(meshes, materials, options)
-    writeUSDA(objects, materials, options)
-    writeUSDZ(materials, options)
+def checkTargets(targets, keywords):
+    for target in targets:
+        shared = [key for key in extractKeywords if key in target]
+        if len(shared) > 0:
+            raise ValueError('Export targets can not set ' + ', '.join(shared) + ', these apply to the shared extraction')
     
-    # Cleanup Temp Directory
-    shutil.rmtree(tempDir)
+    # Every target prints its own scaled copy after the extraction, so there is
+    # no printing to overlap with it
+    if keywords.get('pipelined', False):
+        raise ValueError('Export targets can not be pipelined')
+
+
+def getExtractOptions(keywords, targetOptions):
+    # Extract once at unit scale with everything any of the outputs needs
+    options = getExportOptions(**dict(keywords, filepath=targetOptions[0]['basePath'] + targetOptions[0]['fileName'] + '.usdz'))
+    options['scale'] = 1.0
+    options['keepUSDA'] = False
+    for key in ['exportMaterials', 'animated', 'vertexAnimation', 'bakeAO']:
+        options[key] = any(target[key] for target in targetOptions)
+    return options
+
+
+def scaleRootMatrix(matrix, scale):
+    # Same as exportRootMatrix at the given scale for a matrix exported at unit scale
+    return [tuple(f*scale for f in row[0:3]) + tuple(row[3:]) for row in matrix]
+
+
+def scaleRootJoints(joints, roots, scale):
+    return [tuple(f*scale for f in joint) if i in roots else joint for i, joint in enumerate(joints)]
+
+
+def scaleSkelAnimation(animation, scale):
+    roots = set(i for i, token in enumerate(animation['jointTokens']) if not '/' in token)
+    scaled = dict(animation)
+    scaled['scales'] = [(frame, scaleRootJoints(joints, roots, scale)) for frame, joints in animation['scales']]
+    scaled['translations'] = [(frame, scaleRootJoints(joints, roots, scale)) for frame, joints in animation['translations']]
+    return scaled
+
+
+def getTargetMesh(mesh, options):
+    # Writing sets the prototype and binding, so every output gets its own copy
+    copy = dict(mesh)
+    if not (options['animated'] and options['vertexAnimation']) and mesh['pointSamples'] != None:
+        copy['pointSamples'] = None
+        copy['extent'] = getPointsExtents(mesh['points'])
+    return copy
+
+
+def getTargetObjects(objects, options, root = True):
+    copies = []
+    for object in objects:
+        copy = dict(object)
+        copy['meshes'] = [getTargetMesh(mesh, options) for mesh in object['meshes']]
+        copy['children'] = getTargetObjects(object['children'], options, False)
+        if root and options['scale'] != 1.0:
+            copy['matrix'] = scaleRootMatrix(object['matrix'], options['scale'])
+            copy['timeSamples'] = [(frame, scaleRootMatrix(matrix, options['scale'])) for frame, matrix in object['timeSamples']]
+            if object['animation'] != None:
+                copy['animation'] = scaleSkelAnimation(object['animation'], options['scale'])
+        copies.append(copy)
+    return copies
+
+
+def getTargetMaterials(materials, options):
+    if options['bakeAO']:
+        return materials
+    return [dict(mat, occlusionMap=None) for mat in materials]
+
+
+def exportTargets(objs, extractOptions, targetOptions):
+    beginExport(extractOptions)
+    completed = False
+    try:
+        objects = exportObjects(objs, extractOptions)
+        materials = exportMaterials(objs, extractOptions)
+        
+        # Skinned meshes always export their animation
+        skinned = any(object['skeleton'] != None for object in objects)
+        for options in targetOptions:
+            for key in ['tempDir', 'tempPath', 'startTimeCode', 'endTimeCode', 'timeCodesPerSecond']:
+                options[key] = extractOptions[key]
+            options['animated'] = options['animated'] or skinned
+            writeUSD(getTargetObjects(objects, options), getTargetMaterials(materials, options), options)
+            if options['keepUSDA']:
+                keepFiles(options)
+        completed = True
+    finally:
+        endExport(extractOptions, completed)
 
 
 
@@ -974,22 +1903,97 @@ def exportUSD(objs, options):
 ##                         Export Interface Function                          ##
 ################################################################################
 
-def export_usdz(context, filepath = '', exportMaterials = True, keepUSDA = False, bakeAO = False, samples = 8, scale = 1.0, animated = False):
+def getExportOptions(filepath = '', exportMaterials = True, keepUSDA = False, bakeAO = False, samples = 8, scale = 1.0, animated = False, maxInfluences = 4, influenceThreshold = 0.01, layered = False, workers = 0, animationWorkers = 1, vertexAnimation = False, vertexQuantization = 0.0, maxChunkVertices = 0, stageVertices = 0, pipelined = False, forkWorkers = False, dryRun = False, enforceBudget = False):
     filePath, fileName = os.path.split(filepath)
     fileName, fileType = fileName.split('.')
     
+    options = {}
+    options['basePath'] = filePath + '/'
+    options['fileName'] = fileName
+    options['fileType'] = 'usdz'
+    options['animated'] = animated
+    options['exportMaterials'] = exportMaterials
+    options['keepUSDA'] = keepUSDA
+    options['bakeAO'] = bakeAO
+    options['samples'] = samples
+    options['scale'] = scale
+    options['maxInfluences'] = maxInfluences
+    options['influenceThreshold'] = influenceThreshold
+    options['layered'] = layered
+    options['workers'] = workers
+    options['animationWorkers'] = animationWorkers
+    options['vertexAnimation'] = vertexAnimation
+    options['vertexQuantization'] = vertexQuantization
+    options['maxChunkVertices'] = maxChunkVertices
+    options['stageVertices'] = stageVertices
+    options['pipelined'] = pipelined
+    options['forkWorkers'] = forkWorkers
+    options['pythonPath'] = bpy.app.binary_path_python
+    options['dryRun'] = dryRun
+    options['enforceBudget'] = enforceBudget
+    return options
+
+
+def export_usdz(context, report = None, **keywords):
     if len(context.selected_objects) > 0 and context.active_object != None:
-        options = {}
-        options['basePath'] = filePath + '/'
-        options['fileName'] = fileName
-        options['fileType'] = 'usdz'
-        options['animated'] = animated
-        options['exportMaterials'] = exportMaterials
-        options['keepUSDA'] = keepUSDA
-        options['bakeAO'] = bakeAO
-        options['samples'] = samples
-        options['scale'] = scale
-        
+        options = getExportOptions(**keywords)
         objects = organizeObjects(bpy.context.active_object, bpy.context.selected_objects)
+        
+        # Estimate the size up front and reject assets over the AR budgets
+        if options['dryRun'] or options['enforceBudget']:
+            if not checkBudget(objects, options, report):
+                return {'CANCELLED'}
+            if options['dryRun']:
+                return {'FINISHED'}
         exportUSD(objects, options)
     return {'FINISHED'}
+
+
+def export_usdz_targets(context, targets, report = None, **keywords):
+    # Each target is a dict of keywords overriding the shared ones, like filepath,
+    # scale, exportMaterials or animated. Everything is extracted only once, so
+    # the extractKeywords, like the AO samples, can only be given as shared
+    # keywords.
+    if len(context.selected_objects) > 0 and context.active_object != None and len(targets) > 0:
+        checkTargets(targets, keywords)
+        targetOptions = [getExportOptions(**dict(keywords, **target)) for target in targets]
+        options = getExtractOptions(keywords, targetOptions)
+        objects = organizeObjects(bpy.context.active_object, bpy.context.selected_objects)
+        
+        if options['dryRun'] or options['enforceBudget']:
+            if not checkBudget(objects, options, report):
+                return {'CANCELLED'}
+            if options['dryRun']:
+                return {'FINISHED'}
+        exportTargets(objects, options, targetOptions)
+    return {'FINISHED'}
+
+
+def watch_usdz(context, debounce = 0.5, report = None, **keywords):
+    global activeWatcher
+    unwatch_usdz()
+    if len(context.selected_objects) > 0 and context.active_object != None:
+        options = getExportOptions(**keywords)
+        objects = organizeObjects(bpy.context.active_object, bpy.context.selected_objects)
+        activeWatcher = ExportWatcher(objects, options, debounce)
+        activeWatcher.start()
+    return {'FINISHED'}
+
+
+def unwatch_usdz():
+    global activeWatcher
+    if activeWatcher != None:
+        activeWatcher.stop()
+        activeWatcher = None
+
+
+def start_export_usdz(context, report = None, **keywords):
+    if len(context.selected_objects) > 0 and context.active_object != None:
+        options = getExportOptions(**keywords)
+        objects = organizeObjects(bpy.context.active_object, bpy.context.selected_objects)
+        if options['enforceBudget'] and not checkBudget(objects, options, report):
+            return None
+        job = ExportJob(objects, options)
+        job.start()
+        return job
+    return None
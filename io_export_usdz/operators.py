@@ -0,0 +1,118 @@
+import bpy
+from bpy.props import (
+        BoolProperty,
+        FloatProperty,
+        IntProperty,
+        StringProperty,
+        EnumProperty,
+        )
+from bpy_extras.io_utils import (
+        ImportHelper,
+        ExportHelper,
+        orientation_helper_factory,
+        path_reference_mode,
+        axis_conversion,
+        )
+
+from bpy_extras.io_utils import ExportHelper
+
+class ExportUSDZ(bpy.types.Operator, ExportHelper):
+    bl_idname       = "export.usdz"
+    bl_label        = "Export USDZ File"
+    bl_options      = {'PRESET'}
+
+    filename_ext    = ".usdz"
+
+    exportMaterials = BoolProperty(name="Export Materials", description="Export Materials from Objects", default=True)
+    keepUSDA = BoolProperty(name="Keep USDA", description="Keep generated USDA and image files", default=False)
+    animated = BoolProperty(name="Export Animations", description="Export Ridgid Body Animations", default=False)
+    bakeAO = BoolProperty(name="Bake AO", description="Bake Ambiant Occlusion Texture", default=False)
+    samples = IntProperty(name="Samples", description="Number of Samples for Ambiant Occlusion", min=1, max=1000, default= 8)
+    scale = FloatProperty(name="Scale", min=0.01, max=1000.0, default=1.0)
+    maxInfluences = IntProperty(name="Max Influences", description="Maximum number of joint influences per vertex", min=1, max=4, default=4)
+    influenceThreshold = FloatProperty(name="Influence Threshold", description="Fraction of vertex weight that may be dropped when reducing joint influences", min=0.0, max=1.0, default=0.01)
+    layered = BoolProperty(name="Export Layers", description="Write each top level object and the materials to their own layer", default=False)
+    workers = IntProperty(name="Workers", description="Number of worker processes, 0 uses all cores", min=0, max=256, default=0)
+    vertexAnimation = BoolProperty(name="Vertex Animation", description="Export animated shape key and modifier deformation as animated points, normals stay in the rest pose", default=False)
+    vertexQuantization = FloatProperty(name="Vertex Quantization", description="Grid step animated points are snapped to, 0 disables quantization", min=0.0, max=1.0, precision=4, default=0.0)
+    maxChunkVertices = IntProperty(name="Chunk Vertices", description="Split meshes with more vertices into spatial chunks, 0 disables chunking", min=0, max=10000000, default=0)
+    stageVertices = IntProperty(name="Stage Vertices", description="Stage meshes with more vertices in memory mapped files instead of memory, 0 disables staging", min=0, max=100000000, default=0)
+    pipelined = BoolProperty(name="Pipelined Export", description="Write extracted objects on the workers while the next objects are extracted", default=False)
+    forkWorkers = BoolProperty(name="Fork Workers", description="Fork worker processes from Blender instead of spawning them, faster to start but may deadlock on macOS", default=False)
+    animationWorkers = IntProperty(name="Animation Workers", description="Number of background Blender processes sampling the animation frames", min=1, max=64, default=1)
+    dryRun = BoolProperty(name="Dry Run", description="Only estimate the size and complexity against AR Quick Look budgets", default=False)
+    enforceBudget = BoolProperty(name="Enforce Budget", description="Reject exports exceeding AR Quick Look budgets", default=False)
+    background = BoolProperty(name="Background Export", description="Export without blocking the interface, press Esc to cancel", default=False)
+    watch = BoolProperty(name="Watch", description="Keep re-exporting the selection whenever it changes", default=False)
+    watchDelay = FloatProperty(name="Watch Delay", description="Seconds without changes before re-exporting", min=0.0, max=60.0, default=0.5)
+
+    def execute(self, context):
+        from . import export_usdz
+        keywords = self.as_keywords(ignore=("global_scale",
+                                            "check_existing",
+                                            "filter_glob",
+                                            "background",
+                                            "watch",
+                                            "watchDelay",
+                                            ))
+        keywords['report'] = self.report
+        if self.watch and not self.dryRun:
+            return export_usdz.watch_usdz(context, debounce=self.watchDelay, **keywords)
+        if self.background and not self.dryRun:
+            return self.startBackgroundExport(context, keywords)
+        return export_usdz.export_usdz(context, **keywords)
+
+    def startBackgroundExport(self, context, keywords):
+        from . import export_usdz
+        self.job = export_usdz.start_export_usdz(context, **keywords)
+        if self.job == None:
+            return {'CANCELLED'}
+        self.phase = None
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.01, context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.job.cancel()
+        elif event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        running = self.job.step()
+        context.window_manager.progress_update(int(self.job.progress*100))
+        if self.job.phase != self.phase:
+            self.phase = self.job.phase
+            self.report({'INFO'}, "USDZ Export: " + self.phase)
+        if running:
+            return {'RUNNING_MODAL'}
+
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        if self.job.error != None:
+            self.report({'ERROR'}, "USDZ Export failed: " + str(self.job.error))
+            return {'CANCELLED'}
+        if self.job.cancelled:
+            self.report({'WARNING'}, "USDZ Export cancelled")
+            return {'CANCELLED'}
+        self.report({'INFO'}, "USDZ Export finished")
+        return {'FINISHED'}
+
+
+class StopUSDZWatch(bpy.types.Operator):
+    bl_idname       = "export.usdz_watch_stop"
+    bl_label        = "Stop USDZ Watch"
+
+    def execute(self, context):
+        from . import export_usdz
+        export_usdz.unwatch_usdz()
+        return {'FINISHED'}
+
+
+def menu_func_usdz_export(self, context):
+    self.layout.operator(ExportUSDZ.bl_idname, text="USDZ (.usdz)");
+    from . import export_usdz
+    if export_usdz.activeWatcher != None:
+        self.layout.operator(StopUSDZWatch.bl_idname, text="Stop USDZ Watch");
@@ -0,0 +1,645 @@
+import os
+import sys
+import json
+import types
+import multiprocessing
+import numpy
+
+
+# Printing and writing of USDA files. Nothing here depends on bpy, so worker
+# processes can import this module without a running Blender.
+
+# Defines
+tab = '    '
+epslon = 0.000001
+
+# Staged arrays are written and hashed in blocks of this many rows
+stagedBlockRows = 65536
+stagedMarker = '\x00'
+
+# Whether workers could be spawned, by Python executable
+spawnChecks = {}
+
+
+
+################################################################################
+##                             Helper Methods                                 ##
+################################################################################
+
+# Returns Tuple as comma seprated string
+def printTuple(t):
+    return ', '.join('%.6g' % round(f, 6) for f in t)
+
+def printIndices(indices):
+    if isinstance(indices, StagedArray):
+        return printStaged(indices)
+    return ', '.join(format(i, 'd') for i in indices)
+
+def printVectors(vectors):
+    if isinstance(vectors, StagedArray):
+        return printStaged(vectors)
+    return ', '.join('(' + printTuple(v) + ')' for v in vectors)
+
+
+
+################################################################################
+##                          Progress Helper Methods                           ##
+################################################################################
+
+class ExportCancelled(Exception):
+    pass
+
+
+def checkCancelled(options):
+    event = options.get('cancelEvent')
+    if event != None and event.is_set():
+        raise ExportCancelled()
+
+
+
+################################################################################
+##                          Parallel Helper Methods                           ##
+################################################################################
+
+def getWorkerCount(options):
+    if options['workers'] > 0:
+        return options['workers']
+    return multiprocessing.cpu_count()
+
+
+def getPrintOptions(options):
+    # Only plain values can be sent to worker processes
+    return {k: v for k, v in options.items() if isinstance(v, (bool, int, float, str))}
+
+
+def probeWorker():
+    pass
+
+
+def startProcesses(context, start):
+    # Spawned workers only need this module. Re-running the main script of a
+    # background Blender, which imports bpy, would kill them during startup.
+    main = sys.modules['__main__']
+    if context.get_start_method() != 'fork':
+        sys.modules['__main__'] = types.ModuleType('__mp_main__')
+    try:
+        return start()
+    finally:
+        sys.modules['__main__'] = main
+
+
+def canSpawnWorkers(context, options):
+    # A pool respawns workers that die while starting forever, so check once
+    # per interpreter that a worker can start and import this module
+    if not options['pythonPath'] in spawnChecks:
+        probe = context.Process(target=probeWorker)
+        startProcesses(context, probe.start)
+        try:
+            while probe.exitcode == None:
+                probe.join(0.1)
+                checkCancelled(options)
+        finally:
+            if probe.exitcode == None:
+                probe.terminate()
+                probe.join()
+        spawnChecks[options['pythonPath']] = probe.exitcode == 0
+        if probe.exitcode != 0:
+            print('USDZ export workers failed to start, printing on a single process')
+    return spawnChecks[options['pythonPath']]
+
+
+def getProcessContext(options):
+    # Workers are spawned from Blender's own Python and only import this module.
+    # Forking the running, threaded Blender can deadlock the children, so it
+    # is only an opt-in fallback.
+    if options['forkWorkers']:
+        try:
+            return multiprocessing.get_context('fork')
+        except ValueError:
+            return None
+    if options['pythonPath'] == None:
+        return None
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(options['pythonPath'])
+    if not canSpawnWorkers(context, options):
+        return None
+    return context
+
+
+def startPool(context, workers):
+    return startProcesses(context, lambda: context.Pool(workers))
+
+
+def waitResult(result, options):
+    while not result.ready():
+        result.wait(0.1)
+        checkCancelled(options)
+    return result.get()
+
+
+def mapParallel(function, items, options):
+    # A pool kept in the options, like the one of a watch session, saves
+    # starting the workers again for every call
+    workers = min(getWorkerCount(options), len(items))
+    if workers > 1 and options.get('printPool') != None:
+        return waitResult(options['printPool'].map_async(function, items), options)
+    context = None
+    if workers > 1:
+        context = getProcessContext(options)
+    if context != None:
+        with startPool(context, workers) as pool:
+            return waitResult(pool.map_async(function, items), options)
+    return [function(item) for item in items]
+
+
+
+################################################################################
+##                        Geometry Staging Methods                            ##
+################################################################################
+
+# Huge meshes keep their arrays in memory mapped files in the export temp
+# directory. Only the file location travels with the mesh, so staged meshes
+# stay cheap to cache and to send to worker processes.
+class StagedArray:
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = dtype
+        self.shape = tuple(shape)
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def load(self):
+        return numpy.memmap(self.path, dtype=self.dtype, mode='r', shape=self.shape)
+    
+    def updateHash(self, fingerprint):
+        fingerprint.update(repr((self.dtype, self.shape)).encode())
+        f = open(self.path, 'rb')
+        block = f.read(1024*1024)
+        while len(block) > 0:
+            fingerprint.update(block)
+            block = f.read(1024*1024)
+        f.close()
+
+
+def printStaged(array):
+    # Placeholder expanded by writeSource, which streams the array from disk
+    return stagedMarker + json.dumps([array.path, array.dtype, array.shape]) + stagedMarker
+
+def writeStaged(f, array):
+    values = array.load()
+    for start in range(0, len(values), stagedBlockRows):
+        block = values[start:start + stagedBlockRows].tolist()
+        if start > 0:
+            f.write(', ')
+        if values.ndim > 1:
+            f.write(printVectors(block))
+        else:
+            f.write(printIndices(block))
+
+def writeSource(f, src):
+    parts = src.split(stagedMarker)
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            f.write(part)
+        else:
+            writeStaged(f, StagedArray(*json.loads(part)))
+
+
+################################################################################
+##                          USDA Export Methods                               ##
+################################################################################
+
+def getInfluenceMatrices(vertexWeights):
+    # Pad the per vertex influences to (V, K) matrices of joint indices and weights
+    counts = numpy.array([len(v) for v in vertexWeights], dtype='i8')
+    width = max(int(counts.max()) if len(counts) > 0 else 0, 1)
+    indices = numpy.zeros((len(vertexWeights), width), dtype='i8')
+    weights = numpy.zeros((len(vertexWeights), width), dtype='f8')
+    influences = [g for v in vertexWeights for g in v]
+    if len(influences) > 0:
+        rows = numpy.repeat(numpy.arange(len(vertexWeights)), counts)
+        columns = numpy.arange(len(influences)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        indices[rows, columns] = [g[0] for g in influences]
+        weights[rows, columns] = [g[1] for g in influences]
+    return (indices, weights)
+
+def compactJointInfluences(vertexWeights, maxElements, threshold):
+    indices, weights = getInfluenceMatrices(vertexWeights)
+    totals = weights.sum(axis=1)[:, None]
+    
+    # Strongest influences first, ties keep their vertex group order
+    rows = numpy.arange(len(weights))[:, None]
+    order = numpy.argsort(-weights, axis=1, kind='mergesort')[:, :maxElements]
+    indices = indices[rows, order]
+    weights = weights[rows, order]
+    
+    # Smallest element size keeping the dropped weight of every vertex under threshold
+    fits = totals - numpy.cumsum(weights, axis=1) <= threshold*totals + epslon
+    counts = numpy.where(fits.any(axis=1), fits.argmax(axis=1) + 1, weights.shape[1])
+    elements = max(int(counts.max()) if len(counts) > 0 else 0, 1)
+    
+    indices = indices[:, :elements]
+    weights = weights[:, :elements]
+    totals = weights.sum(axis=1)[:, None]
+    weights = numpy.where(totals > epslon, weights/numpy.maximum(totals, epslon), 0.0)
+    return (indices.reshape(-1).tolist(), weights.reshape(-1).tolist(), elements)
+
+def printJointIndices(indices, elements):
+    src = 2*tab + 'int[] primvars:skel:jointIndices = [' + printIndices(indices) + '] (\n'
+    src += 3*tab + 'elementSize = %d\n' %elements
+    src += 3*tab + 'interpolation = "vertex"\n'
+    src += 2*tab + ')\n'
+    return src
+
+def printJointWeights(weights, elements):
+    src = 2*tab + 'float[] primvars:skel:jointWeights = [' + printTuple(weights) + '] (\n'
+    src += 3*tab + 'elementSize = %d\n' %elements
+    src += 3*tab + 'interpolation = "vertex"\n'
+    src += 2*tab + ')\n'
+    return src
+
+def printMeshInstance(mesh, options, indent):
+    src = indent + tab + 'def Mesh "' + mesh['name'] + '" (\n'
+    src += indent + 2*tab + 'prepend references = <' + mesh['prototype'] + '>\n'
+    src += indent + tab + ')\n'
+    src += indent + tab + '{\n'
+    if options['exportMaterials']:
+        src += indent + 2*tab + 'rel material:binding = </Materials/' + mesh['binding'] + '>\n'
+    src += indent + tab + '}\n'
+    src += indent + tab + '\n'
+    return src
+
+def printMesh(mesh, options, indent):
+    if mesh['prototype'] != None:
+        return printMeshInstance(mesh, options, indent)
+    src = indent + tab + 'def Mesh "' + mesh['name'] + '"\n'
+    src += indent + tab + '{\n'
+    src += indent + 2*tab + 'float3[] extent = [' + printVectors(mesh['extent']) + ']\n'
+    src += indent + 2*tab + 'int[] faceVertexCounts = [' + printIndices(mesh['faceVertexCounts']) + ']\n'
+    src += indent + 2*tab + 'int[] faceVertexIndices = [' + printIndices(mesh['faceVertexIndices']) + ']\n'
+    if options['exportMaterials']:
+        src += indent + 2*tab + 'rel material:binding = </Materials/' + mesh['binding'] + '>\n'
+    src += indent + 2*tab + 'point3f[] points = [' + printVectors(mesh['points']) + ']\n'
+    if mesh['pointSamples'] != None:
+        src += indent + 2*tab + 'point3f[] points.timeSamples = {\n' + printTimeSamples(mesh['pointSamples'], indent)
+        src += indent + 2*tab + '}\n'
+    src += indent + 2*tab + 'normal3f[] primvars:normals = [' + printVectors(mesh['normals']) + '] (\n'
+    src += indent + 3*tab + 'interpolation = "vertex"\n'
+    src += indent + 2*tab + ')\n'
+    src += indent + 2*tab + 'int[] primvars:normals:indices = [' + printIndices(mesh['normalIndices']) + ']\n'
+    if mesh['uvs'] != None:
+        src += indent + 2*tab + 'texCoord2f[] primvars:Texture_uv = [' + printVectors(mesh['uvs']) + '] (\n'
+        src += indent + 3*tab + 'interpolation = "faceVarying"\n'
+        src += indent + 2*tab + ')\n'
+        src += indent + 2*tab + 'int[] primvars:Texture_uv:indices = [' + printIndices(mesh['uvIndices']) + ']\n'
+    if mesh['weights'] != None:
+        indices, weights, elements = compactJointInfluences(mesh['weights'], options['maxInfluences'], options['influenceThreshold'])
+        src += printJointIndices(indices, elements)
+        src += printJointWeights(weights, elements)
+    if mesh['skeleton'] != None and mesh['animationSource'] != None:
+        src += indent + 2*tab + 'prepend rel skel:animationSource = <' + mesh['animationSource'] + '>\n'
+        src += indent + 2*tab + 'prepend rel skel:skeleton = <' + mesh['skeleton'] + '>\n'
+    src += indent + 2*tab + 'uniform token subdivisionScheme = "none"\n'
+    src += indent + tab + '}\n'
+    src += indent + tab + '\n'
+    return src
+
+def printMeshes(meshes, options, indent):
+    src = ''
+    for mesh in meshes:
+        printed = getPrintedPrim(mesh, options, indent)
+        if printed != None and mesh['prototype'] == None:
+            src += printed
+        else:
+            src += printMesh(mesh, options, indent)
+    return src
+
+def printSkeleton(skeleton, options, indent):
+    src = indent + tab + 'def Skeleton "' + skeleton['name'] + '"\n'
+    src += indent + tab + '{\n'
+    src += indent + 2*tab + 'uniform token[] joints = [' + ', '.join('"' + t + '"' for t in skeleton['jointTokens']) + ']\n'
+    src += indent + 2*tab + 'uniform matrix4d[] bindTransforms = [' + ', '.join('(' + printVectors(m) + ')' for m in skeleton['bindTransforms']) + ']\n'
+    src += indent + 2*tab + 'uniform matrix4d[] restTransforms = [' + ', '.join('(' + printVectors(m) + ')' for m in skeleton['restTransforms']) + ']\n'
+    src += indent + tab + '}\n'
+    return src
+
+def printTimeSamples(samples, indent):
+    src = ''
+    for sample in samples:
+        src += indent + 3*tab + '%d: [' % sample[0] + printVectors(sample[1]) + '],\n'
+    return src
+
+def printSkelAnimation(animation, options, indent):
+    src = indent + tab + 'def SkelAnimation "' + animation['name'] + '"\n'
+    src += indent + tab + '{\n'
+    src += indent + 2*tab + 'uniform token[] joints = [' + ', '.join('"' + t + '"' for t in animation['jointTokens']) + ']\n'
+    src += indent + 2*tab + 'quatf[] rotations.timeSamples = {\n' + printTimeSamples(animation['rotations'], indent)
+    src += indent + 2*tab + '}\n'
+    src += indent + 2*tab + 'half3[] scales.timeSamples = {\n' + printTimeSamples(animation['scales'], indent)
+    src += indent + 2*tab + '}\n'
+    src += indent + 2*tab + 'float3[] translations.timeSamples = {\n' + printTimeSamples(animation['translations'], indent)
+    src += indent + 2*tab + '}\n'
+    src += indent + tab + '}\n'
+    return src
+
+def printMatrix(mtx):
+    return 'custom matrix4d xformOp:transform = (' + printVectors(mtx) + ')'
+
+def printTimeTransforms(timeCodes, indent):
+    src = indent + tab + 'matrix4d xformOp:transform:transforms.timeSamples = {\n'
+    for time, mtx in timeCodes:
+        src += indent + 2*tab + '%d: (' % time + printVectors(mtx) + '),\n'
+    src += indent + tab + '}\n'
+    src += indent + tab + 'uniform token[] xformOpOrder = ["xformOp:transform:transforms"]\n'
+    return src
+
+def printTimeCodes(animation):
+    src = tab + 'endTimeCode = %d\n' % animation['endTimeCode']
+    src += tab + 'startTimeCode = %d\n' % animation['startTimeCode']
+    src += tab + 'timeCodesPerSecond = %d\n' % animation['timeCodesPerSecond']
+    return src
+
+def printSubLayers(layers):
+    src = tab + 'subLayers = [\n'
+    src += ',\n'.join(2*tab + '@' + layer + '@' for layer in layers) + '\n'
+    src += tab + ']\n'
+    return src
+
+def printLayerMetadata(options, subLayers = []):
+    src = ''
+    if options['animated']:
+        src += printTimeCodes(options)
+    if len(subLayers) > 0:
+        src += printSubLayers(subLayers)
+    if len(src) > 0:
+        return '(\n' + src + ')\n'
+    return src
+
+def printRigidObject(obj, options, indent):
+    src = indent + 'def Xform "' + obj['name'] + '"\n'
+    src += indent + '{\n'
+    if options['animated']:
+        src += printTimeTransforms(obj['timeSamples'], indent)
+    else:
+        src += indent + tab + printMatrix(obj['matrix']) + '\n'
+        src += indent + tab + 'uniform token[] xformOpOrder = ["xformOp:transform"]\n'
+    src += indent + tab + '\n'
+    if len(obj['children']):
+        src += printObjects(obj['children'], options, indent + tab)
+        src += indent + tab + '\n'
+    src += printMeshes(obj['meshes'], options, indent)
+    src += indent + '}\n\n'
+    return src
+
+def printSkinnedObject(obj, options, indent):
+    src = indent + 'def SkelRoot "' + obj['name'] + '"\n'
+    src += indent + '{\n'
+    src += printMeshes(obj['meshes'], options, indent)
+    src += printSkeleton(obj['skeleton'], options, indent)
+    src += indent + tab + '\n'
+    printed = getPrintedPrim(obj['animation'], options, indent)
+    if printed != None:
+        src += printed
+    else:
+        src += printSkelAnimation(obj['animation'], options, indent)
+    src += indent + '}\n\n'
+    return src
+
+def printObjects(objs, options, indent):
+    src = ''
+    for obj in objs:
+        checkCancelled(options)
+        if obj['skeleton'] == None:
+            src += printRigidObject(obj, options, indent)
+        else:
+            src += printSkinnedObject(obj, options, indent)
+    return src
+
+def collectPrims(objs, indent, prims):
+    for obj in objs:
+        if obj['skeleton'] == None:
+            collectPrims(obj['children'], indent + tab, prims)
+        for mesh in obj['meshes']:
+            prims.append(('mesh', mesh, indent))
+        if obj['animation'] != None:
+            prims.append(('animation', obj['animation'], indent))
+
+def printPrim(prim):
+    kind, data, indent, options = prim
+    if kind == 'mesh':
+        return printMesh(data, options, indent)
+    return printSkelAnimation(data, options, indent)
+
+def getPrimKey(prim):
+    # Mesh text also depends on the instancing and binding resolved at write time
+    kind, data, indent = prim
+    if kind == 'mesh':
+        return (id(data), indent, data['prototype'], data['binding'])
+    return (id(data), indent)
+
+def printPrims(objs, options):
+    prims = []
+    collectPrims(objs, '', prims)
+    
+    # A print cache keeps the prims of unchanged data between writes. Entries
+    # hold on to their data so the ids in the keys cannot be reused.
+    cache = options.get('printCache', {})
+    missing = [prim for prim in prims if not getPrimKey(prim) in cache]
+    printOptions = getPrintOptions(options)
+    sources = mapParallel(printPrim, [(kind, data, indent, printOptions) for kind, data, indent in missing], options)
+    for prim, src in zip(missing, sources):
+        cache[getPrimKey(prim)] = (prim[1], src)
+    if 'printCache' in options:
+        options['printCache'] = {getPrimKey(prim): cache[getPrimKey(prim)] for prim in prims}
+    
+    # Results are keyed by the prim and its indentation
+    printed = {}
+    for prim in prims:
+        kind, data, indent = prim
+        printed[(id(data), indent)] = cache[getPrimKey(prim)][1]
+    return printed
+
+def getPrintedPrim(prim, options, indent):
+    if 'printedPrims' in options:
+        return options['printedPrims'].get((id(prim), indent))
+    return None
+
+
+def printPbrShader(mat):
+    src = 2*tab + 'def Shader "pbr"\n'
+    src += 2*tab + '{\n'
+    src += 3*tab + 'uniform token info:id = "UsdPreviewSurface"\n'
+    src += 3*tab + 'float inputs:clearcoat = %.6g\n' % mat['clearcoat']
+    src += 3*tab + 'float inputs:clearcoatRoughness = %.6g\n' % mat['clearcoatRoughness']
+    
+    if mat['colorMap'] == None:
+        src += 3*tab + 'color3f inputs:diffuseColor = (' + printTuple(mat['color'][:3]) + ')\n'
+    else:
+        src += 3*tab + 'color3f inputs:diffuseColor.connect = </Materials/' + mat['name'] + '/color_map.outputs:rgb>\n'
+    
+    if mat['emissiveMap'] == None:
+        src += 3*tab + 'color3f inputs:emissiveColor = (' + printTuple(mat['emissive'][:3]) + ')\n'
+    else:
+        src += 3*tab + 'color3f inputs:emissiveColor.connect = </Materials/' + mat['name'] + '/emissive_map.outputs:rgb>\n'
+    
+    src += 3*tab + 'float inputs:displacement = %.6g\n' % mat['displacement']
+    src += 3*tab + 'float inputs:ior = %.6g\n' % mat['ior']
+    
+    if mat['metallicMap'] == None:
+        src += 3*tab + 'float inputs:metallic = %.6g\n' % mat['metallic']
+    else:
+        src += 3*tab + 'float inputs:metallic.connect = </Materials/' + mat['name'] + '/metallic_map.outputs:r>\n'
+    
+    if mat['normalMap'] == None:
+        src += 3*tab + 'normal3f inputs:normal = (0, 0, 1)\n'
+    else:
+        src += 3*tab + 'normal3f inputs:normal.connect = </Materials/' + mat['name'] + '/normal_map.outputs:rgb>\n'
+    
+    if mat['occlusionMap'] == None:
+        src += 3*tab + 'float inputs:occlusion = 0\n'
+    else:
+        src += 3*tab + 'float inputs:occlusion.connect = </Materials/' + mat['name'] + '/ao_map.outputs:r>\n'
+    
+    if mat['roughnessMap'] == None:
+        src += 3*tab + 'float inputs:roughness = %.6g\n' % mat['roughness']
+    else:
+        src += 3*tab + 'float inputs:roughness.connect = </Materials/' + mat['name'] + '/roughness_map.outputs:r>\n'
+    
+    src += 3*tab + 'float inputs:opacity = %.6g\n' % mat['opacity']
+    src += 3*tab + 'color3f inputs:specularColor = (' + printTuple(mat['specular']) + ')\n'
+    src += 3*tab + 'int inputs:useSpecularWorkflow = %i\n' % int(mat['specularWorkflow'])
+    src += 3*tab + 'token outputs:displacement\n'
+    src += 3*tab + 'token outputs:surface\n'
+    src += 2*tab + '}\n'
+    src += 2*tab + '\n'
+    return src
+
+def printShaderPrimvar(name):
+    src = 2*tab + 'def Shader "Primvar"\n'
+    src += 2*tab + '{\n'
+    src += 3*tab + 'uniform token info:id = "UsdPrimvarReader_float2"\n'
+    src += 3*tab + 'float2 inputs:default = (0, 0)\n'
+    src += 3*tab + 'token inputs:varname.connect = </Materials/' + name + '.inputs:frame:stPrimvarName>\n'
+    src += 3*tab + 'float2 outputs:result\n'
+    src += 2*tab + '}\n'
+    src += 2*tab + '\n'
+    return src
+
+def printShaderTexture(compName, matName, default, comps, file):
+    src = 2*tab + 'def Shader "' + compName + '"\n' 
+    src += 2*tab + '{\n'
+    src += 3*tab + 'uniform token info:id = "UsdUVTexture"\n'
+    src += 3*tab + 'float4 inputs:default = (' + printTuple(default) + ')\n'
+    if file != None:
+        src += 3*tab + 'asset inputs:file = @' + file + '@\n'
+    src += 3*tab + 'float2 inputs:st.connect = </Materials/' + matName + '/Primvar.outputs:result>\n'
+    src += 3*tab + 'token inputs:wrapS = "repeat"\n'
+    src += 3*tab + 'token inputs:wrapT = "repeat"\n'
+    if comps == 3:
+        src += 3*tab + 'float3 outputs:rgb\n'
+    else:
+        src += 3*tab + 'float outputs:r\n'
+    src += 2*tab + '}\n'
+    return src
+
+def printMaterial(mat, options):
+    name = mat['name']
+    
+    src = tab + 'def Material "' + name + '"\n' + tab + '{\n'
+    
+    src += 2*tab + 'token inputs:frame:stPrimvarName = "Texture_uv"\n'
+    src += 2*tab + 'token outputs:displacement.connect = </Materials/' + name + '/pbr.outputs:displacement>\n'
+    src += 2*tab + 'token outputs:surface.connect = </Materials/' + name + '/pbr.outputs:surface>\n'
+    src += 2*tab + '\n'
+    
+    src += printPbrShader(mat)
+    src += printShaderPrimvar(name)
+    
+    if mat['colorMap'] != None:
+        src += printShaderTexture('color_map', name, mat['color'], 3, mat['colorMap']) + '\n'
+    if mat['normalMap'] != None:
+        src += printShaderTexture('normal_map', name, (0, 0, 1, 1), 3, mat['normalMap']) + '\n'
+    if mat['occlusionMap'] != None:
+        src += printShaderTexture('ao_map', name, (0, 0, 0, 1), 1, mat['occlusionMap']) + '\n'
+    if mat['emissiveMap'] != None:
+        src += printShaderTexture('emissive_map', name, mat['emissive'], 3, mat['emissiveMap']) + '\n'
+    if mat['metallicMap'] != None:
+        src += printShaderTexture('metallic_map', name, (mat['metallic'], mat['metallic'], mat['metallic'], 1.0), 1, mat['metallicMap']) + '\n'
+    if mat['roughnessMap'] != None:
+        src += printShaderTexture('roughness_map', name, (mat['roughness'], mat['roughness'], mat['roughness'], 1.0), 1, mat['roughnessMap'])
+    
+    src += tab + '}\n' + tab + '\n'
+    return src
+
+def printMaterials(materials, options):
+    src = ''
+    if options['exportMaterials'] and len(materials) > 0:
+        src += 'def "Materials"\n{\n'
+        for material in materials:
+            src += printMaterial(material, options)
+        src += '}\n\n'
+    return src
+
+def writeUSDA(objs, materials, options, printed = None):
+    usdaFile = options['tempPath'] + options['fileName'] + '.usda'
+    options['usdaFiles'] = [options['fileName'] + '.usda']
+    src = '#usda 1.0\n'
+    src += printLayerMetadata(options)
+    src += '\n'
+    
+    #Add the Objects, with the meshes and animations serialized in parallel
+    if printed == None:
+        printed = printPrims(objs, options)
+    options['printedPrims'] = printed
+    try:
+        src += printObjects(objs, options, '')
+    finally:
+        del options['printedPrims']
+    
+    # Add the Materials
+    src += printMaterials(materials, options)
+    
+    # Write to file, streaming staged arrays from disk
+    f = open(usdaFile, 'w')
+    writeSource(f, src)
+    f.close()
+
+def printLayer(layer):
+    kind, data, options = layer
+    src = '#usda 1.0\n'
+    src += printLayerMetadata(options)
+    src += '\n'
+    if kind == 'materials':
+        src += printMaterials(data, options)
+    else:
+        src += printObjects([data], options, '')
+    return src
+
+def writeLayeredUSDA(objs, materials, options):
+    usdaFile = options['tempPath'] + options['fileName'] + '.usda'
+    printOptions = getPrintOptions(options)
+    
+    # One layer per top level object and one for the Materials scope
+    layerFiles = []
+    layers = []
+    for obj in objs:
+        layerFiles.append(options['fileName'] + '_' + obj['name'] + '.usda')
+        layers.append(('object', obj, printOptions))
+    if options['exportMaterials']:
+        layerFiles.append(options['fileName'] + '_Materials.usda')
+        layers.append(('materials', materials, printOptions))
+    options['usdaFiles'] = [options['fileName'] + '.usda'] + layerFiles
+    
+    # Serialize the independent layers concurrently
+    for layerFile, src in zip(layerFiles, mapParallel(printLayer, layers, options)):
+        f = open(options['tempPath'] + layerFile, 'w')
+        writeSource(f, src)
+        f.close()
+    
+    # Write the root layer
+    src = '#usda 1.0\n'
+    src += printLayerMetadata(options, layerFiles)
+    f = open(usdaFile, 'w')
+    f.write(src)
+    f.close()